@@ -0,0 +1,144 @@
+import asyncio
+import hashlib
+import json
+import random
+import time
+from collections import Counter
+from aiohttp import web
+
+
+def user_id(login):
+    return str(int.from_bytes(hashlib.md5(login.encode()).digest()[:4], 'big'))
+
+
+class FakeTwitch:
+    # A local stand-in for the Helix endpoints the bot uses and for the
+    # twitchinsights feed, with latency, a per-minute rate limit and errors.
+    def __init__(self, latency=0.05, jitter=0.02, rate_limit=800, error_rate=0.0, moderator_id='1'):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.error_rate = error_rate
+        self.moderator_id = moderator_id
+        self.feed = []
+        self.feed_version = 0
+        self.missing = set()
+        self.gone = set()
+        self.broken = set()
+        self.logins = {}
+        self.no_mod = set()
+        self.bans = {}
+        self.calls = Counter()
+        self.tokens = rate_limit
+        self.window = time.time()
+        self.runner = None
+
+    def set_feed(self, names):
+        self.feed = [[name, 1, int(time.time())] for name in names]
+        self.feed_version += 1
+
+    def ban_list(self, channel_id):
+        return self.bans.setdefault(channel_id, {})
+
+    def ratelimit_headers(self):
+        now = time.time()
+        if now - self.window >= 60:
+            self.window = now
+            self.tokens = self.rate_limit
+        return {
+            'Ratelimit-Limit': str(self.rate_limit),
+            'Ratelimit-Remaining': str(max(0, self.tokens)),
+            'Ratelimit-Reset': str(int(self.window + 60)),
+        }
+
+    async def helix(self, request, handler):
+        self.calls[f'{request.method} {request.path}'] += 1
+        await asyncio.sleep(max(0, random.gauss(self.latency, self.jitter)))
+        self.tokens -= 1
+        headers = self.ratelimit_headers()
+        if self.tokens < 0:
+            self.calls['429'] += 1
+            return web.json_response({'status': 429, 'message': 'Too Many Requests'}, status=429, headers=headers)
+        if random.random() < self.error_rate:
+            self.calls['5xx'] += 1
+            return web.json_response({'status': 503, 'message': 'Service Unavailable'}, status=503, headers=headers)
+        status, body = handler(request)
+        if status == 204:
+            return web.Response(status=204, headers=headers)
+        return web.json_response(body, status=status, headers=headers)
+
+    def register(self, logins):
+        self.logins.update((user_id(login), login) for login in logins)
+
+    def users(self, request):
+        logins = request.query.getall('login', [])
+        if self.broken.intersection(logins):
+            return 400, {'status': 400, 'message': 'Malformed query params.'}
+        logins += [self.logins[uid] for uid in request.query.getall('id', []) if uid in self.logins]
+        return 200, {'data': [{'id': user_id(login), 'login': login} for login in logins if login not in self.missing]}
+
+    def ban(self, request):
+        channel_id = request.query['broadcaster_id']
+        if channel_id in self.no_mod:
+            return 403, {'status': 403, 'message': 'The user in moderator_id is not one of the broadcaster\'s moderators.'}
+        banned = self.ban_list(channel_id)
+        target = json.loads(request['body'])['data']['user_id']
+        if target in self.gone:
+            return 400, {'status': 400, 'message': 'The user specified in the user_id field does not exist.'}
+        if target in banned:
+            return 400, {'status': 400, 'message': 'The user specified in the user_id field is already banned.'}
+        banned[target] = request.query['moderator_id']
+        return 200, {'data': [{'broadcaster_id': channel_id, 'user_id': target}]}
+
+    def unban(self, request):
+        channel_id = request.query['broadcaster_id']
+        if channel_id in self.no_mod:
+            return 403, {'status': 403, 'message': 'The user in moderator_id is not one of the broadcaster\'s moderators.'}
+        if request.query['user_id'] in self.gone:
+            return 400, {'status': 400, 'message': 'The user specified in the user_id field does not exist.'}
+        if self.ban_list(channel_id).pop(request.query['user_id'], None) is None:
+            return 400, {'status': 400, 'message': 'The user specified in the user_id field is not banned.'}
+        return 204, None
+
+    def banned(self, request):
+        channel_id = request.query['broadcaster_id']
+        if channel_id in self.no_mod:
+            return 403, {'status': 403, 'message': 'Forbidden'}
+        entries = list(self.ban_list(channel_id).items())
+        start = int(request.query.get('after', 0))
+        first = int(request.query.get('first', 20))
+        page = [{'user_id': target, 'moderator_id': moderator} for target, moderator in entries[start:start + first]]
+        pagination = {'cursor': str(start + first)} if start + first < len(entries) else {}
+        return 200, {'data': page, 'pagination': pagination}
+
+    async def feed_handler(self, request):
+        self.calls['GET /v1/bots/all'] += 1
+        etag = f'"{self.feed_version}"'
+        if request.headers.get('If-None-Match') == etag:
+            return web.Response(status=304)
+        return web.json_response({'bots': self.feed, '_total': len(self.feed)}, headers={'ETag': etag})
+
+    def app(self):
+        async def body(request, handler):
+            request['body'] = await request.text()
+            return await self.helix(request, handler)
+
+        app = web.Application()
+        app.router.add_get('/helix/users', lambda request: body(request, self.users))
+        app.router.add_post('/helix/moderation/bans', lambda request: body(request, self.ban))
+        app.router.add_delete('/helix/moderation/bans', lambda request: body(request, self.unban))
+        app.router.add_get('/helix/moderation/banned', lambda request: body(request, self.banned))
+        app.router.add_get('/v1/bots/all', self.feed_handler)
+        return app
+
+    async def start(self, host='127.0.0.1', port=0):
+        self.runner = web.AppRunner(self.app())
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = self.runner.addresses[0][1]
+        return f'http://{host}:{port}'
+
+    async def close(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
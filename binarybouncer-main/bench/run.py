@@ -0,0 +1,223 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+import aiohttp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+for key, value in (('API_KEY', 'bench'), ('BOT_ID', '1'), ('BOT_NAME', 'binarybouncer')):
+    os.environ.setdefault(key, value)
+
+import utils
+from bot import BOT, BANS
+from engine import BanEngine, FAILED
+from feed import BotFeed
+from jobs import JobQueue
+from outbox import ChatOutbox
+from prune import Pruner
+from resolver import UserResolver
+from stories import Storyteller
+from bench.fake_twitch import FakeTwitch, user_id
+
+
+class BenchToken:
+    # Stands in for the authenticated twitchAPI client the engine reads from.
+    app_id = 'bench'
+
+    def get_user_auth_token(self):
+        return 'bench'
+
+    async def refresh_used_token(self):
+        pass
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+async def make_bot(url, fake, session):
+    async def send(channel, text):
+        pass
+
+    async def write(names):
+        return {}
+
+    bot = BOT(None, None, [], os.environ['BOT_NAME'])
+    bot.twitch = BenchToken()
+    bot.session = session
+    bot.engine = BanEngine(bot.twitch, fake.moderator_id, session, helix_url=f'{url}/helix')
+    bot.feed = BotFeed(session, url=f'{url}/v1/bots/all')
+    state = await utils.open_state()
+    bot.resolver = UserResolver(bot.engine, state)
+    bot.jobs = JobQueue(state, bot.run_job)
+    bot.pruner = Pruner(state, bot.resolver, bot.engine, pace=0.05)
+    bot.outbox = ChatOutbox(send)
+    bot.storyteller = Storyteller(state, write, bot.outbox.broadcast, utils.get_limerick)
+    return bot
+
+
+async def onboard(bot, fake, args):
+    bots = {f'bot{i}': user_id(f'bot{i}') for i in range(args.bots)}
+    utils.get_state().add_bots(bots)
+    start = time.monotonic()
+    await bot.mass_ban('streamer', '100')
+    await asyncio.gather(*(task for job, task in list(bot.jobs.tasks.values())))
+    return time.monotonic() - start, f'{len(fake.ban_list("100"))} bans in one channel'
+
+
+async def burst(bot, fake, args):
+    existing = [f'old{i}' for i in range(args.bots)]
+    state = utils.get_state()
+    state.add_known(existing)
+    for i in range(args.channels):
+        state.add_channel(f'channel{i}', str(1000 + i))
+    fake.set_feed(existing + [f'new{i}' for i in range(args.burst)])
+    start = time.monotonic()
+    await bot.ban_routine()
+    bans = sum(len(banned) for banned in fake.bans.values())
+    return time.monotonic() - start, f'{bans} bans for {args.burst} new bots across {args.channels} channels'
+
+
+async def rebuild(bot, fake, args):
+    names = [f'name{i}' for i in range(args.names)]
+    fake.missing = set(names[::20])
+    fake.set_feed(names)
+    start = time.monotonic()
+    await bot.build_banlist()
+    alive = len(utils.get_state().alive)
+    return time.monotonic() - start, f'{alive} alive, {len(fake.missing)} dead of {args.names} names'
+
+
+async def prune(bot, fake, args):
+    names = [f'bot{i}' for i in range(args.bots)]
+    fake.register(names)
+    fake.missing = set(names[::10])
+    utils.get_state().add_bots({name: user_id(name) for name in names})
+    start = time.monotonic()
+    await bot.pruner.sweep_alive()
+    state = utils.get_state()
+    return time.monotonic() - start, f'{len(state.alive)} alive, {len(state.dead)} dead of {args.bots} bots'
+
+
+async def leave(bot, fake, args):
+    bots = {f'bot{i}': user_id(f'bot{i}') for i in range(args.bots)}
+    utils.get_state().add_bots(bots)
+    await bot.mass_ban('streamer', '100')
+    await asyncio.gather(*(task for job, task in list(bot.jobs.tasks.values())))
+    manual = {f'manual{i}': 'streamer' for i in range(args.bots // 10)}
+    fake.ban_list('100').update(manual)
+    # Bans by an earlier shard account of bots no longer in the alive list,
+    # plus one whose account has been deleted since.
+    utils.get_state().defer('add_account', '2', 'earlier')
+    earlier = [f'earlier{i}' for i in range(args.bots // 10)]
+    fake.register(earlier)
+    fake.ban_list('100').update((user_id(name), '2') for name in earlier)
+    fake.gone.add(user_id('deleted'))
+    fake.ban_list('100')[user_id('deleted')] = fake.moderator_id
+    start = time.monotonic()
+    await bot.mass_unban('streamer', '100')
+    await asyncio.gather(*(task for job, task in list(bot.jobs.tasks.values())))
+    left = fake.ban_list('100')
+    named_by_id = sum(name.isdigit() for name in utils.get_state().dead)
+    return time.monotonic() - start, f'{len(left)} bans left in the channel, {sum(name in left for name in manual)} of {len(manual)} manual bans kept, {named_by_id} dead bots named by their ID'
+
+
+async def stale(bot, fake, args):
+    # Fans out bots whose stored ID Helix no longer knows: one in five each
+    # is current, renamed (new ID), stale with the same ID, deleted, or has a
+    # login whose lookup fails. Every (bot, channel) pair must get a result.
+    bots = {}
+    for i in range(args.burst):
+        name = f'bot{i}'
+        kind = i % 5
+        bots[name] = user_id(f'{name}-old' if kind == 1 else name)
+        if kind:
+            fake.gone.add(bots[name])
+        if kind == 3:
+            fake.missing.add(name)
+        elif kind == 4:
+            fake.broken.add(name)
+    state = utils.get_state()
+    state.add_bots(bots)
+    for i in range(args.channels):
+        state.add_channel(f'channel{i}', str(1000 + i))
+    before = dict(BANS.values)
+    start = time.monotonic()
+    await bot.ban_in_channels(bots)
+    # Unbans without an ID look the login up first, which fails for these.
+    unbans = [await bot.unban(name, '1000', 'channel0') for name in bots if name in fake.broken]
+    elapsed = time.monotonic() - start
+    results = {dict(key)['result']: count - before.get(key, 0) for key, count in BANS.values.items()}
+    pairs = len(bots) * args.channels
+    lost = pairs - sum(results.values())
+    summary = ', '.join(f'{count} {result}' for result, count in sorted(results.items()) if count)
+    return elapsed, f'{pairs} pairs: {summary}, {lost} without a result; {unbans.count(FAILED)} of {len(unbans)} unbans by login failed cleanly'
+
+
+SCENARIOS = {'onboard': onboard, 'burst': burst, 'rebuild': rebuild, 'prune': prune, 'leave': leave, 'stale': stale}
+
+
+async def run_scenario(name, args):
+    fake = FakeTwitch(latency=args.latency, rate_limit=args.rate_limit, error_rate=args.error_rate)
+    url = await fake.start()
+    latencies = []
+
+    async def on_request_start(session, context, params):
+        context.start = time.monotonic()
+
+    async def on_request_end(session, context, params):
+        latencies.append(time.monotonic() - context.start)
+
+    trace = aiohttp.TraceConfig()
+    trace.on_request_start.append(on_request_start)
+    trace.on_request_end.append(on_request_end)
+    with tempfile.TemporaryDirectory() as workdir:
+        os.makedirs(os.path.join(workdir, 'data'))
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        utils._state = utils._feed_index = None
+        try:
+            async with aiohttp.ClientSession(trace_configs=[trace]) as session:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    bot = await make_bot(url, fake, session)
+                    elapsed, summary = await SCENARIOS[name](bot, fake, args)
+                await bot.engine.close()
+        finally:
+            await utils.get_state().close()
+            utils._state = None
+            os.chdir(cwd)
+            await fake.close()
+    calls = sum(count for key, count in fake.calls.items() if key[0] in 'GPD')
+    print(f'{name}: {elapsed:.2f}s, {summary}')
+    print(f'  {calls} API calls ({calls / elapsed:.1f}/s), latency p50 {percentile(latencies, 50) * 1000:.0f}ms p99 {percentile(latencies, 99) * 1000:.0f}ms')
+    for key, count in sorted(fake.calls.items()):
+        print(f'    {key}: {count}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the ban pipeline against a local fake Twitch.')
+    parser.add_argument('scenario', nargs='*', default=list(SCENARIOS), help=f'any of {", ".join(SCENARIOS)} (default: all)')
+    parser.add_argument('--latency', type=float, default=0.05, help='mean Helix latency in seconds')
+    parser.add_argument('--rate-limit', type=int, default=6000, help='Helix requests per minute (Twitch gives 800)')
+    parser.add_argument('--error-rate', type=float, default=0.01, help='fraction of Helix calls answered with a 503')
+    parser.add_argument('--bots', type=int, default=5000, help='alive bots for onboarding / feed size for the burst')
+    parser.add_argument('--channels', type=int, default=100)
+    parser.add_argument('--burst', type=int, default=50, help='new bots in the burst and stale scenarios')
+    parser.add_argument('--names', type=int, default=20000, help='feed size for the rebuild scenario')
+    args = parser.parse_args()
+    for name in args.scenario:
+        if name not in SCENARIOS:
+            parser.error(f'unknown scenario {name}')
+    for name in args.scenario:
+        asyncio.run(run_scenario(name, args))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,50 @@
 from twitchAPI.twitch import Twitch
-from twitchAPI.oauth import UserAuthenticator
+from twitchAPI.oauth import UserAuthenticationStorageHelper
 from twitchAPI.type import AuthScope, ChatEvent
 from twitchAPI.chat import Chat, EventData, ChatMessage, ChatCommand
-from twitchAPI.helper import first
 from utils import *
-from gpt import create_prompt
+from gpt import create_limericks
+from engine import BanEngine, priority, BANNED, UNBANNED, ALREADY, NOT_FOUND, NO_MOD, FAILED, FANOUT, COMMAND, BULK
+from resolver import UserResolver
+from jobs import JobQueue
+from stories import Storyteller
+from feed import BotFeed
+from outbox import ChatOutbox
+from shards import ShardCoordinator, ShardWorker
+from poller import Poller
+from prune import Pruner
+from metrics import Counter, Histogram, serve
 import asyncio
 import os
+import signal
 import aiohttp
-import json
 import datetime
+import logging
+import time
+from pathlib import PurePath
 from dotenv import load_dotenv
 
 load_dotenv(dotenv_path=os.path.join('config', '.env'))
 
+FANOUT_WORKERS = 20
+JOB_ROUNDS = 3
+JOB_RETRY_WAIT = 30
+SHARD_PORT = int(os.environ.get('SHARD_PORT', 8765))
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 9100))
+ROUTINE_MIN_INTERVAL = int(os.environ.get('ROUTINE_MIN_INTERVAL', 60))
+ROUTINE_MAX_INTERVAL = int(os.environ.get('ROUTINE_MAX_INTERVAL', 900))
+SHUTDOWN_GRACE = int(os.environ.get('SHUTDOWN_GRACE', 30))
+TOKEN_FILE = os.environ.get('TOKEN_FILE')
+
+log = logging.getLogger('bot')
+
+BANS = Counter('bans_total', 'Ban attempts by result.')
+UNBANS = Counter('unbans_total', 'Unban attempts by result.')
+CHANNEL_ERRORS = Counter('channel_errors_total', 'Failed bans and unbans by channel and result.')
+NEW_BOTS = Counter('new_bots_total', 'New bots found in the feed and resolved.')
+ROUTINE_SECONDS = Histogram('ban_routine_seconds', 'Duration of a ban_routine run.')
+DETECTION_LATENCY = Histogram('detection_to_ban_seconds', 'Time from a bot batch being detected to being banned in every channel.')
+
 class BOT:
     def __init__(self, app_id, app_secret, user_scope, target_channel):
         self.app_id = app_id
@@ -22,45 +53,160 @@ class BOT:
         self.target_channel = target_channel
         self.twitch = None
         self.chat = None
+        self.engine = None
+        self.resolver = None
+        self.jobs = None
+        self.storyteller = None
+        self.session = None
+        self.feed = None
+        self.outbox = None
+        self.shard = None
+        self.shard_task = None
+        self.poller = None
+        self.pruner = None
+        self.metrics = None
+        self.stopping = None
         self.bot_id = os.environ['BOT_ID']
         self.bot_name = os.environ['BOT_NAME']
+        self.role = os.environ.get('SHARD_ROLE', 'standalone')
         
 
     async def on_ready(self, ready_event: EventData):
         print('Bot is ready for work')
         await ready_event.chat.join_room(self.target_channel)
-        await self.loop_stuff()
+        self.outbox.start()
+        await self.jobs.resume(self.owns)
+        if self.role != 'worker':
+            self.storyteller.start()
+            self.pruner.start()
+            await self.loop_stuff()
 
 
     async def on_message(self, msg: ChatMessage):
-        print(f'in {msg.room.name}, {msg.user.name} said: {msg.text}')
+        log.debug('in %s, %s said: %s', msg.room.name, msg.user.name, msg.text)
 
 
-    async def get_user_id(self, username):
-        try:
-            user = await first(self.twitch.get_users(logins=[username]))
-            return user.id
-        except Exception as e:
-            print(f"Error: {e}")
-            return None
+    def say(self, text, channel=None):
+        if self.role == 'worker':
+            # Streamers talk to the coordinator's account, so worker replies go out through it.
+            asyncio.create_task(self.shard.send({'type': 'say', 'text': text, 'channel': channel}))
+            return
+        self.outbox.reply(channel or self.target_channel, text)
+
+
+    def owns(self, channel):
+        return self.shard is None or self.shard.owner(channel) == self.bot_name
+
+
+    def rebalance(self):
+        self.jobs.release(self.owns)
+        asyncio.create_task(self.jobs.resume(self.owns))
+
+
+    async def on_shard_message(self, message):
+        if message['type'] == 'members':
+            print(f'Shards are now {", ".join(message["shards"])}')
+            self.rebalance()
+        elif message['type'] == 'bots':
+            await get_state().reload()
+            with priority(FANOUT):
+                await self.ban_in_channels(message['bots'], message.get('channels'))
+            await self.sync()
+            DETECTION_LATENCY.observe(time.time() - message.get('detected', time.time()))
+        elif message['type'] == 'job':
+            await get_state().reload()
+            await self.dispatch_job(message['action'], message['channel'], message['channel_id'])
+        elif message['type'] == 'cancel':
+            self.jobs.cancel(message['channel_id'])
+
+
+    async def on_coordinator_message(self, shard, message):
+        if message['type'] == 'say':
+            self.say(message['text'], message.get('channel'))
+        elif message['type'] == 'no_mod':
+            await self.handle_no_mod(message['channel'], message['channel_id'], shard, message.get('onboarding', False), message.get('bots'))
+        elif message['type'] == 'changed':
+            await get_state().reload()
+
+
+    async def sync(self):
+        # Workers write channels, bots and counters to the shared store, so the
+        # coordinator is told to reload once their writes are flushed.
+        if self.role == 'worker':
+            await get_state().flush()
+            await self.shard.send({'type': 'changed'})
+
+
+    async def report_no_mod(self, channel, channel_id, onboarding=False, bots=None):
+        # A worker never drops a channel itself: only the coordinator decides.
+        # bots are the ones that could not be banned there, for the next owner.
+        if self.role == 'worker':
+            await self.shard.send({'type': 'no_mod', 'channel': channel, 'channel_id': channel_id, 'onboarding': onboarding, 'bots': bots})
+        else:
+            await self.handle_no_mod(channel, channel_id, self.bot_name, onboarding, bots)
+
+
+    async def handle_no_mod(self, channel, channel_id, account, onboarding, bots=None):
+        if onboarding:
+            await remove_channel(channel_id)
+            self.say(f'@{channel}, {account} needs to be a moderator on your channel (/mod {account}), then type !join again.')
+            return
+        # The channel moves to the next shard on the ring that has not failed
+        # there, which also resumes any job left open on it. A report for an
+        # account already moved off is a batch that was in flight at the time.
+        owner = None
+        if self.role == 'coordinator' and account in self.shard.unmodded.get(channel, ()):
+            owner = self.shard.owner(channel)
+        elif self.role == 'coordinator':
+            owner = await self.shard.exclude(channel, account)
+            if owner is not None:
+                log.warning('Shard %s is not a moderator in channel %s, handing it to %s', account, channel, owner)
+                self.say(f'@{channel}, {account} is not a moderator on your channel, {owner} is banning bots there instead.')
+        if owner is None:
+            self.jobs.cancel(channel_id)
+            if self.role == 'coordinator':
+                await self.shard.reset(channel)
+            await remove_channel(channel_id)
+            self.say(f'@{channel}, {self.bot_name} needs to be a moderator on your channel to work! Stopping services on your channel.')
+        elif bots and owner == self.bot_name:
+            with priority(FANOUT):
+                await self.ban_in_channels(bots, {channel: channel_id})
+        elif bots:
+            await self.shard.send(owner, {'type': 'bots', 'bots': bots, 'channels': {channel: channel_id}})
+
+
+    async def dispatch_job(self, action, channel, channel_id):
+        if self.role == 'coordinator':
+            owner = self.shard.owner(channel)
+            await get_state().flush()
+            if owner != self.bot_name and await self.shard.send(owner, {'type': 'job', 'action': action, 'channel': channel, 'channel_id': channel_id}):
+                print(f'Handed {action} job on {channel}\'s channel to shard {owner}')
+                return
+        if action == 'ban':
+            await self.mass_ban(channel, channel_id)
+        else:
+            await self.mass_unban(channel, channel_id)
+
+
+    async def get_user_id(self, username, use_cache=True):
+        found, missing = await self.resolver.resolve([username], use_cache)
+        return found.get(username.lower())
         
 
     async def build_banlist(self):
-        url = 'https://api.twitchinsights.net/v1/bots/all'
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                if response.status == 200:
-                    botlist = await response.json()
-                    bots = botlist['bots']
-                    for name in range(len(bots)):
-                        user_id = await self.get_user_id(bots[name][0])
-                        if user_id is None:
-                            await self.del_bot(bots[name][0], user_id)
-                        else:
-                            await self.add_bot(bots[name][0], user_id)
-                        await asyncio.sleep(0.1)
-                else:
-                    print(f"Failed to fetch data. Status code: {response.status}")
+        bots, changed = await self.feed.fetch()
+        if bots is None:
+            print('Failed to fetch the bot list, banlist not rebuilt')
+            return
+        # Diff it here too and ban the new bots like the routine does.
+        new_bots, dropped = await process_bots(bots)
+        found, missing = await self.resolver.resolve(bot[0] for bot in bots)
+        await add_bots(found)
+        if missing:
+            await del_bots(dict.fromkeys(missing))
+        if new_bots:
+            with priority(FANOUT):
+                await self.handle_new_bots(new_bots)
 
 
     async def join(self, input):
@@ -74,15 +220,17 @@ class BOT:
         has_joined = await check_if_joined(name)
         if not has_joined:
             await add_channel(name, user_id)
-            finished = await self.mass_ban(name, user_id)
-            if finished:
-                if isinstance(input, ChatCommand):
-                    await self.chat.send_message(self.bot_name, f'{name}, you are now protected.')
-                else:
-                    print(f'{name} forcefully added to the join list and is now protected.')
+            if self.role == 'coordinator':
+                await self.shard.reset(name)
+            owner = self.shard.owner(name) if self.role == 'coordinator' else self.bot_name
+            if owner != self.bot_name:
+                self.say(f'{name}, your channel is handled by {owner}, please make it a moderator as well (/mod {owner}).')
+            await self.dispatch_job('ban', name, user_id)
+            if not isinstance(input, ChatCommand):
+                print(f'{name} forcefully added to the join list and is now protected.')
         else:
             if isinstance(input, ChatCommand):
-                await self.chat.send_message(self.bot_name, f'{name}, You are already protected.')
+                self.say(f'{name}, You are already protected.')
             else:
                 print(f'Unable to add {name} to the join list because they are already protected.')
 
@@ -97,251 +245,438 @@ class BOT:
         user_id = await self.get_user_id(name)
         has_joined = await check_if_joined(name)
         if has_joined:
+            self.jobs.cancel(user_id)
+            if self.role == 'coordinator':
+                await self.shard.broadcast({'type': 'cancel', 'channel_id': user_id})
             await remove_channel(user_id)
             await self.twitch.remove_channel_moderator(user_id, self.bot_id)
             await del_from_limerick(name)
             if isinstance(input, ChatCommand):
-                await self.chat.send_message(self.bot_name, f'You have left the bot-free zone, {name}, New bots will no longer be banned on your channel.')   
+                self.say(f'You have left the bot-free zone, {name}, New bots will no longer be banned on your channel.')   
             else:
                 print(f'{name}')   
         else:
             if isinstance(input, ChatCommand):
-                await self.chat.send_message(self.bot_name, f'{name}, you were not on my protected list.')
+                self.say(f'{name}, you were not on my protected list.')
             else:
                 print(f'{name} was not on our protected list, unable to remove.')
 
 
     async def leave_and_unban(self, cmd: ChatCommand):
-        user_id = await self.get_user_id(cmd.user.name)
-        has_joined = await check_if_joined(cmd.user.name)
-        if has_joined:
-            await self.mass_unban(cmd.user.name, user_id)
-            await remove_channel(user_id)
-            await del_from_limerick(cmd.user.name)
-            try:
-                await self.twitch.remove_channel_moderator(user_id, self.bot_id)
-            except Exception as e:
-                print(f'Error removing mod (probably already dont have it) - {e}')
-            await self.chat.send_message(self.bot_name, f'{cmd.user.name} -- You have left the bot-free zone and I have unbanned all bots on your channel.')
+        user_id = await get_channel_id(cmd.user.name)
+        if user_id is not None:
+            await self.dispatch_job('unban', cmd.user.name, user_id)
         else:
-            await self.chat.send_message(self.bot_name, f'{cmd.user.name}, you are not currently my protected list, unable to mass-unban.')
+            self.say(f'{cmd.user.name}, you are not currently my protected list, unable to mass-unban.')
     
 
-    async def ban_bot(self, username, channel_id, channel):
-        ban_successful = await self.ban(username, channel_id, channel)
-        if ban_successful == channel:
-            await self.chat.send_message(self.bot_name, f'@{username}, {self.bot_name} needs to be a moderator on your channel to work! Stopping services on your channel.')
+    async def refresh_user_id(self, username, stale_id=None):
+        # Returns (user_id, missing): missing is True only when Twitch says the
+        # user does not exist, not when the lookup itself failed.
+        found, missing = await self.resolver.resolve([username], use_cache=stale_id is None)
+        user_id = found.get(username.lower())
+        if missing:
+            print(f'Error: Could not find user {username}, added to deadbots.')
+            await del_bot(username, user_id)
+        elif user_id is not None and stale_id is not None and user_id != stale_id:
+            await add_bot(username, user_id)
+        return user_id, bool(missing)
+
+
+    async def lookup(self, username, user_id):
+        # Fresh ID for a user Helix did not find, or the result to give up with.
+        fresh_id, missing = await self.refresh_user_id(username, user_id)
+        if fresh_id is None:
+            return None, NOT_FOUND if missing else FAILED
+        if fresh_id == user_id:
+            return None, FAILED
+        return fresh_id, None
     
 
-    async def ban(self, username, channel_id, channel, reason='Bot'):
-        user_id = await self.get_user_id(username)
+    async def ban(self, username, channel_id, channel, reason='Bot', user_id=None):
+        # Returns the engine result (BANNED, ALREADY, NOT_FOUND, NO_MOD, FAILED).
         if user_id is None:
-            print(f'Error: Could not find user {username}')
-            await del_bot(username, user_id)
-            return None
-        try:
-            await self.twitch.ban_user(channel_id, self.bot_id, user_id, reason)
-            print(f'Banned user {username} from channel ({channel})')
-        except KeyError as e:
-            if e.args and e.args[0] == 'data':
-                print(f'Error: The "data" key is missing in the response while banning user {username} in channel {channel}.')
-                await remove_channel(channel_id)
-                print('Bot does not have moderator permissions in channel so we left:', channel)
-                return channel
-            else:
-                print(f'KeyError: {e}. User {username} not banned in channel {channel}, likely already banned or does not exist.')
-                return None
-        except Exception as e:
-            print(f'An unexpected error occurred while banning user {username} in channel {channel_id}: {e}')
-            return None
+            user_id, missing = await self.refresh_user_id(username)
+            if user_id is None:
+                return NOT_FOUND if missing else FAILED
+        result = await self.engine.ban(channel_id, user_id, reason)
+        if result == NOT_FOUND:
+            fresh_id, failed = await self.lookup(username, user_id)
+            if fresh_id is None:
+                BANS.inc(result=failed)
+                return failed
+            user_id = fresh_id
+            result = await self.engine.ban(channel_id, user_id, reason)
+        BANS.inc(result=result)
+        if result not in (BANNED, ALREADY):
+            CHANNEL_ERRORS.inc(channel=channel, result=result)
+        if result == BANNED:
+            await record_ban(channel_id, username, user_id, self.bot_id)
+            log.debug('Banned user %s from channel (%s)', username, channel)
+        elif result == NO_MOD:
+            log.warning('Bot does not have moderator permissions in channel: %s', channel)
+        elif result == ALREADY:
+            log.debug('User %s is already banned in channel %s.', username, channel)
+        else:
+            log.warning('Could not ban user %s in channel %s: %s', username, channel, result)
+        return result
         
     
-    async def unban(self, username, channel_id, channel):
-        user_id = await self.get_user_id(username)
+    async def unban(self, username, channel_id, channel, user_id=None):
+        # Returns the engine result (UNBANNED, ALREADY, NOT_FOUND, NO_MOD, FAILED).
         if user_id is None:
-            print(f'{username} got perma-banned. Added to deadbots.')
-            await del_bot(username, user_id)
-            return None  
-        try:
-            await self.twitch.unban_user(channel_id, self.bot_id, user_id)
-            print(f'Unbanned user {username} from channel ({channel})')
-            return None
-        except KeyError as e:
-            if e.args and e.args[0] == 'data':
-                print(f'Error: The "data" key is missing in the response while banning user {username} in channel {channel}.')
-                await remove_channel(channel_id)
-                print(f'Error: Lacking permissions to unban {username} in channel {channel_id} so we left.')
-                return channel
-            else:
-                print(f'KeyError: {e}.')
-                return None
-        except Exception as e:
-            print(f"An unexpected error occurred while unbanning {username} in channel {channel_id}: {e}")
-            return None  
+            user_id, missing = await self.refresh_user_id(username)
+            if user_id is None:
+                return NOT_FOUND if missing else FAILED
+        result = await self.engine.unban(channel_id, user_id)
+        if result == NOT_FOUND and username == str(user_id):
+            # Only known by its ID (the account is gone), so there is no login to look up.
+            UNBANS.inc(result=result)
+            await forget_ban(channel_id, user_id)
+            return result
+        if result == NOT_FOUND:
+            fresh_id, failed = await self.lookup(username, user_id)
+            if fresh_id is None:
+                UNBANS.inc(result=failed)
+                if failed == NOT_FOUND:
+                    await forget_ban(channel_id, user_id)
+                return failed
+            result = await self.engine.unban(channel_id, fresh_id)
+        UNBANS.inc(result=result)
+        if result not in (UNBANNED, ALREADY):
+            CHANNEL_ERRORS.inc(channel=channel, result=result)
+        if result in (UNBANNED, ALREADY):
+            await forget_ban(channel_id, user_id)
+        if result == UNBANNED:
+            log.debug('Unbanned user %s from channel (%s)', username, channel)
+        elif result == NO_MOD:
+            log.warning('Lacking permissions to unban %s in channel %s.', username, channel_id)
+        elif result == ALREADY:
+            log.debug('User %s is not banned in channel %s.', username, channel)
+        else:
+            log.warning('Could not unban user %s in channel %s: %s', username, channel, result)
+        return result
 
 
     async def mass_ban(self, channel, channel_id):  
-        await self.chat.send_message(self.bot_name, f'Starting mass exodus of bots on {channel}\'s channel. This can take around ~1hr, please be patient...')
-        finished = await self.massban_from_channel(channel, channel_id)
-        if finished == channel:
-            await self.chat.send_message(self.bot_name, f'@{channel}, Please add {self.bot_name} as a moderator and try again (sometimes it takes a minute or two to register the new mod).')
+        # The account that will do the bans must be a moderator before anything is queued.
+        if await self.engine.is_moderator(channel_id) is False:
+            await self.report_no_mod(channel, channel_id, onboarding=True)
+            return
+        # The alive bots are streamed straight into the job, never copied.
+        bots = (await alive_bots()).items()
+        banned = await self.engine.banned_users(channel_id)
+        if banned is not None:
+            bots = ((bot_name, bot_id) for bot_name, bot_id in bots if bot_id not in banned)
+        job = await self.jobs.submit(channel, channel_id, 'ban', bots)
+        if banned is not None:
+            print(f'{channel} already has {len(banned)} bans, {job.size} bots left to ban')
+        self.say(f'Starting mass exodus of {job.size} bots on {channel}\'s channel. This should only take a few minutes, please be patient...')
+
+
+    async def mass_unban(self, channel, channel_id):
+        # Only bots this service banned here are unbanned: the ledger plus
+        # every ban Twitch says one of our accounts made (any shard, including
+        # earlier owners of the channel), which covers bans from before the
+        # ledger existed. A ban the streamer made is never touched.
+        ledger = await banned_by_us(channel_id)
+        banned = await self.engine.banned_users(channel_id)
+        if banned is None and not ledger:
+            self.say(f'@{channel}, I could not read your ban list right now, please try again in a few minutes.')
+            return
+        accounts = {self.bot_id, *(await our_accounts())}
+        accounts.update(moderator_id for bot_name, bot_id, moderator_id in ledger if moderator_id)
+        bots = {bot_id: bot_name for bot_name, bot_id, moderator_id in ledger if banned is None or banned.get(bot_id) in accounts}
+        if banned is not None:
+            ours = {bot_id for bot_id, moderator_id in banned.items() if moderator_id in accounts and bot_id not in bots}
+            bots.update(await self.name_bots(ours))
+        job = await self.jobs.submit(channel, channel_id, 'unban', [(bot_name, bot_id) for bot_id, bot_name in bots.items()])
+        self.say(f'Starting mass unbanning of {job.size} bots on {channel}\'s channel. This should only take a few minutes, please be patient and do not unmod {self.bot_name} until it is over...')
+
+
+    async def name_bots(self, user_ids):
+        # User ID -> login for bans the ledger does not have, from the alive
+        # bots or else from Twitch. An account Twitch no longer returns keeps
+        # its ID as its name, which unban() knows not to look up.
+        names = {bot_id: bot_name for bot_name, bot_id in (await alive_bots()).items() if bot_id in user_ids}
+        unknown = [user_id for user_id in user_ids if user_id not in names]
+        if unknown:
+            found, missing = await self.resolver.check_ids(unknown)
+            names.update(found)
+        names.update((user_id, user_id) for user_id in user_ids if user_id not in names)
+        return names
+
+
+    async def run_job(self, job):
+        action = self.ban if job.action == 'ban' else self.unban
+        items = await self.jobs.pending(job)
+        # Unbans only touch the channel's ledger, so they run as a command
+        # with more workers and report progress to the streamer as they go.
+        unban = job.action == 'unban'
+        milestones = {len(items) * quarter // 4 for quarter in (1, 2, 3)} if unban and len(items) >= 100 else set()
+        done = 0
+
+        async def step(bot_name, bot_id):
+            nonlocal done
+            result = await action(bot_name, job.channel_id, job.channel, user_id=bot_id)
+            if result == NO_MOD:
+                return job.channel
+            # Failed bots stay pending so the next round (or a resume) retries them.
+            if result in (BANNED, UNBANNED, ALREADY, NOT_FOUND):
+                self.jobs.done(job, bot_name)
+                done += 1
+                if done in milestones:
+                    self.say(f'{job.channel} -- unbanned {done} of {total} bots so far...')
+            return None
+
+        total = len(items)
+        finished = None
+        for attempt in range(JOB_ROUNDS):
+            if attempt:
+                await asyncio.sleep(JOB_RETRY_WAIT * attempt)
+            with priority(COMMAND if unban else BULK):
+                finished = await self.engine.run(step, items, workers=FANOUT_WORKERS if unban else None)
+            items = await self.jobs.pending(job)
+            if finished or not items:
+                break
+        if items and not finished:
+            self.say(f'@{job.channel}, {len(items)} bots could not be {"unbanned" if unban else "banned"} yet, they will be retried later.')
+            raise RuntimeError(f'{len(items)} of {total} bots failed')
+        if finished and self.shard is not None:
+            # The job stays open for the shard that takes the channel over.
+            await self.report_no_mod(job.channel, job.channel_id)
+            raise RuntimeError(f'{self.bot_name} is not a moderator there, another shard takes it over')
+        if job.action == 'ban':
+            await self.finish_mass_ban(job.channel, job.channel_id, finished)
         else:
-            await self.chat.send_message(self.bot_name, f'Finished banning all bots on {channel}\'s channel.')
-            await update_total_joined(True)
-    
+            await self.finish_mass_unban(job.channel, job.channel_id, finished)
+        await self.sync()
 
-    async def massban_from_channel(self, channel, channel_id):
-        file_path = os.path.join('data', 'alivebots.json')
-        with open(file_path, 'r') as file:
-            active_bots = json.load(file)
-            for bot_name, bot_id in active_bots.items():
-                try:
-                    result = await self.ban(bot_name, channel_id, channel)
-                    if result == channel:
-                        return channel
-                    print(f"Mass exodus on {channel}'s channel -- {bot_name}, {bot_id}")
-                    await asyncio.sleep(0.4)
-                except Exception as e:
-                    print(f'Error: {e}')
-        return None
 
+    async def finish_mass_ban(self, channel, channel_id, finished):
+        if finished == channel:
+            await remove_channel(channel_id)
+            self.say(f'@{channel}, Please add {self.bot_name} as a moderator and try again (sometimes it takes a minute or two to register the new mod).')
+        else:
+            self.say(f'Finished banning all bots on {channel}\'s channel.')
+            await update_total_joined(True)
 
 
-    async def mass_unban(self, channel, channel_id):
-        await self.chat.send_message(self.bot_name, f'Starting mass unbanning of bots on {channel}\'s channel. This can take around ~1hr, please be patient and do not unmod {self.bot_name} until it is over...')
-        finished = await self.mass_unban_from_channel(channel, channel_id)
-        await asyncio.sleep(1)
+    async def finish_mass_unban(self, channel, channel_id, finished):
         if finished == channel:
-            await self.chat.send_message(f'@{channel}, Please add {self.bot_name} as a moderator and try again.')
-        if finished:
-            await self.chat.send_message(self.bot_name, f'Finished unbanning all bots on {channel}\'s channel.')
+            self.say(f'@{channel}, Please add {self.bot_name} as a moderator and try again.')
+        else:
             await update_total_joined(False)
-
-    
-    async def mass_unban_from_channel(self, channel, channel_id):
-        file_path = os.path.join('data', 'alivebots.json')
-        with open(file_path, 'r') as file:
-            active_bots = json.load(file)
-            for bot_name, bot_id in active_bots.items():
-                try:
-                    await self.unban(bot_name, channel_id, channel)
-                    print(f"Mass unbanning on {channel}'s channel -- {bot_name}, {bot_id}")
-                    await asyncio.sleep(0.4)
-                except Exception as e:
-                    print(f'No mod privileges on channel {channel}, stopping the mass-unban. Error: {e}')
-                    return channel
-        return None
+        await remove_channel(channel_id)
+        await del_from_limerick(channel)
+        try:
+            await self.twitch.remove_channel_moderator(channel_id, self.bot_id)
+        except Exception as e:
+            print(f'Error removing mod (probably already dont have it) - {e}')
+        if finished != channel:
+            self.say(f'{channel} -- You have left the bot-free zone and I have unbanned all bots on your channel.')
 
 
     async def ban_routine(self):
-        bots = await fetch_bots()
+        with ROUTINE_SECONDS.time():
+            return await self.run_ban_routine()
+
+
+    async def run_ban_routine(self):
+        # Returns the number of new bots found, or None if the feed could not
+        # be fetched, which is what the poller adapts its interval to.
+        bots, changed = await self.feed.fetch()
+        if bots is None:
+            print('Skipping ban routine, could not fetch the bot list')
+            return None
         formatted_date = datetime.datetime.now().strftime('%H:%M:%S %m/%d/%Y')
-        new_bots = await process_bots(bots)
+        detected = time.time()
+        if not changed:
+            print('Bot list unchanged since the last fetch')
+        # The snapshot is diffed even when the feed did not change: bots that
+        # were fetched but never resolved (a failed lookup, or a restart in
+        # between) are not known yet and are picked up again here.
+        new_bots, dropped = await process_bots(bots)
         if new_bots:
-            await self.handle_new_bots(new_bots)
+            with priority(FANOUT):
+                await self.handle_new_bots(new_bots, detected)
         await update_last_routine(formatted_date)
         print('Super_Ban list Updated at', formatted_date)
-
-
-    async def handle_new_bots(self, result):
-        for name in result:
+        return len(new_bots)
+
+
+    async def handle_new_bots(self, result, detected=None):
+        detected = detected or time.time()
+        result = list(result)
+        found, missing = await self.resolver.resolve(result)
+        looked_up = set(found).union(missing)
+        unresolved = len(result) - sum(name.lower() in looked_up for name in result)
+        if unresolved:
+            print(f'Could not look up {unresolved} new bots, retrying them next routine')
+        await add_known([name for name in result if name.lower() in looked_up])
+        if missing:
+            await del_bots(dict.fromkeys(missing))
+        await add_bots(found)
+        NEW_BOTS.inc(len(found))
+        if self.role == 'coordinator':
+            await get_state().flush()
+            await self.shard.broadcast({'type': 'bots', 'bots': found, 'detected': detected})
+        await self.ban_in_channels(found)
+        DETECTION_LATENCY.observe(time.time() - detected)
+        for name in found:
             try:
-                user_id = await self.get_user_id(name)
-                await add_bot(name, user_id)
-                await self.ban_in_channels(name, user_id)
                 await update_counters(name)
-                await self.tell_story(name)
             except Exception as e:
                 print(f'Error handling the bot {name}: {e}')
+        self.tell_story(found)
+
+
+    async def ban_in_channels(self, bots, channels=None):
+        # Fans the whole batch out over every channel at once, bot by bot so
+        # each channel gets the first bot before anyone gets the second.
+        # channels limits it to some channels (a batch handed over by a shard).
+        channel_data = {channel: channel_id for channel, channel_id in (channels or await get_channels()).items() if self.owns(channel)}
+        dropped = {}
 
+        async def step(name, user_id, channel, channel_id):
+            if channel in dropped:
+                return None
+            if await self.ban(name, channel_id, channel, user_id=user_id) == NO_MOD:
+                dropped[channel] = channel_id
+            return None
 
-    async def ban_in_channels(self, name, user_id):
-        file_path = os.path.join('data', 'channels.json')
-        with open(file_path, 'r') as channels:
-            channel_data = json.load(channels)
-            for channel in channel_data:
-                await self.ban_bot(name, channel_data[channel], channel)
-                await asyncio.sleep(0.4)
+        pairs = ((name, user_id, channel, channel_id) for name, user_id in bots.items() for channel, channel_id in channel_data.items())
+        await self.engine.run(step, pairs, workers=FANOUT_WORKERS)
+        print(f'Banned {len(bots)} new bots across {len(channel_data) - len(dropped)} channels')
+        for channel, channel_id in dropped.items():
+            await self.report_no_mod(channel, channel_id, bots=bots)
 
     async def alert(self, cmd: ChatCommand):
         if await check_if_joined(cmd.user.name):
             in_limerick = await check_if_in_limerick(cmd.user.name)
             if not in_limerick:
                 await add_to_limerick(cmd.user.name)
-                await self.chat.send_message(self.bot_name, f'{cmd.user.name} - You have been added to the silly limericks alerts')
+                self.say(f'{cmd.user.name} - You have been added to the silly limericks alerts')
             else:
-                await self.chat.send_message(self.bot_name, f'{cmd.user.name} - You are already added to the limerick alerts')
+                self.say(f'{cmd.user.name} - You are already added to the limerick alerts')
         else:
-            await self.chat.send_message(self.bot_name, f'{cmd.user.name}, you need to join first before managing limerick alerts.')
+            self.say(f'{cmd.user.name}, you need to join first before managing limerick alerts.')
 
     async def noalert(self, cmd: ChatCommand):
         if await check_if_joined(cmd.user.name):
             in_limerick = await check_if_in_limerick(cmd.user.name)
             if in_limerick:
                 await del_from_limerick(cmd.user.name)
-                await self.chat.send_message(self.bot_name, f'{cmd.user.name} - You have been removed from the silly limericks alerts')
+                self.say(f'{cmd.user.name} - You have been removed from the silly limericks alerts')
             else:
-                await self.chat.send_message(self.bot_name, f'{cmd.user.name} - You were not receiving alerts.')
+                self.say(f'{cmd.user.name} - You were not receiving alerts.')
         else:
-            await self.chat.send_message(self.bot_name, f'{cmd.user.name}, you need to join first before managing limerick alerts.')
+            self.say(f'{cmd.user.name}, you need to join first before managing limerick alerts.')
 
 
 
-    async def tell_story(self, name):
-        try:
-            completion = create_prompt(name)
-            print(f'sad story about {name}', completion)
-            file_path = os.path.join('data', 'limerick.txt')
-            with open(file_path, 'r') as limericks:
-                for line in limericks:
-                    chan = line.strip()
-                    await self.chat.send_message(chan, completion.choices[0].message.content)
-                    await asyncio.sleep(0.4)
-        except Exception as e:
-            print('found error', e)
+    def tell_story(self, names):
+        self.storyteller.submit(names)
 
 
-    async def run_periodically(self, coro, interval_seconds):
-        while True:
-            await asyncio.sleep(interval_seconds)
-            await coro()
+    async def loop_stuff(self):
+        self.poller.start()
 
 
-    async def loop_stuff(self):
-        interval_seconds = 900
-        coro = self.ban_routine
-        await coro()
-        asyncio.create_task(self.run_periodically(coro, interval_seconds))
-        
+    def stop(self):
+        print('Stopping, finishing in-flight bans first...')
+        self.stopping.set()
+
+
+    def handle_signals(self):
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self.stop)
+            except NotImplementedError:
+                # Windows has no loop signal handlers.
+                signal.signal(sig, lambda signum, frame: loop.call_soon_threadsafe(self.stop))
+
+
+    async def shutdown(self):
+        # New-bot fan-out gets SHUTDOWN_GRACE seconds to finish; mass jobs are
+        # stopped where they are and resume from the store on the next start.
+        await self.poller.stop(SHUTDOWN_GRACE)
+        self.pruner.close()
+        if self.role == 'worker':
+            self.shard_task.cancel()
+            if self.shard.tasks:
+                await asyncio.wait(self.shard.tasks, timeout=SHUTDOWN_GRACE)
+        await self.jobs.stop()
+        self.storyteller.close()
+        await self.outbox.drain(5)
+        self.outbox.close()
+        self.chat.stop()
+        if self.role == 'coordinator':
+            await self.shard.close()
+        await self.engine.close()
+        await self.session.close()
+        await self.metrics.cleanup()
+        await self.twitch.close()
+        await get_state().close()
+        print('Stopped')
+
 
     async def run(self):
+        self.stopping = asyncio.Event()
         self.twitch = await Twitch(self.app_id, self.app_secret)
-        auth = UserAuthenticator(self.twitch, self.user_scope)
-        token, refresh_token = await auth.authenticate()
-        await self.twitch.set_user_authentication(token, self.user_scope, refresh_token)
+        # The user token is stored and kept refreshed per account, so only the
+        # first start (or a revoked token) needs the browser. Signal handlers
+        # go in after it, so until then Ctrl+C simply interrupts the login.
+        token_file = TOKEN_FILE or os.path.join('config', f'{self.bot_name}_token.json')
+        os.makedirs(os.path.dirname(token_file) or '.', exist_ok=True)
+        await UserAuthenticationStorageHelper(self.twitch, self.user_scope, storage_path=PurePath(token_file)).bind()
+        self.handle_signals()
+        self.metrics = await serve(port=METRICS_PORT)
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=50))
+        state = await open_state()
+        state.start()
+        await add_account(self.bot_id, self.bot_name)
+        self.engine = BanEngine(self.twitch, self.bot_id, self.session)
+        self.feed = BotFeed(self.session)
+        get_feed_index().seed(bot[0] for bot in self.feed.bots)
+        self.resolver = UserResolver(self.engine, state)
+        self.jobs = JobQueue(state, self.run_job)
+        self.pruner = Pruner(state, self.resolver, self.engine)
+        self.outbox = ChatOutbox(lambda chan, text: self.chat.send_message(chan, text))
+        self.storyteller = Storyteller(state, create_limericks, self.outbox.broadcast, get_limerick)
+        self.poller = Poller(self.ban_routine, ROUTINE_MIN_INTERVAL, ROUTINE_MAX_INTERVAL)
 
         self.chat = await Chat(self.twitch)
         self.chat.register_event(ChatEvent.READY, self.on_ready)
         self.chat.register_event(ChatEvent.MESSAGE, self.on_message)
-        self.chat.register_command('join', self.join)
-        self.chat.register_command('leave', self.leave)
-        self.chat.register_command('ilovebots', self.leave_and_unban)
-        self.chat.register_command('alert', self.alert)
-        self.chat.register_command('noalert', self.noalert)
+        if self.role != 'worker':
+            self.chat.register_command('join', self.join)
+            self.chat.register_command('leave', self.leave)
+            self.chat.register_command('ilovebots', self.leave_and_unban)
+            self.chat.register_command('alert', self.alert)
+            self.chat.register_command('noalert', self.noalert)
+        if self.role == 'coordinator':
+            self.shard = ShardCoordinator(self.bot_name, self.rebalance, self.on_coordinator_message, port=SHARD_PORT)
+            await self.shard.start()
+        elif self.role == 'worker':
+            self.shard = ShardWorker(self.bot_name, self.on_shard_message, port=SHARD_PORT)
+            self.shard_task = asyncio.create_task(self.shard.run())
         self.chat.start()
 
         try:
-            input('press ENTER to stop\n')
+            print('Bot is running, press Ctrl+C or send SIGTERM to stop')
+            await self.stopping.wait()
         finally:
-            self.chat.stop()
-            await self.twitch.close()
+            await self.shutdown()
 
 
 if __name__ == '__main__':
+    logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO'), format='%(asctime)s %(levelname)s %(name)s: %(message)s')
     APP_ID = os.environ['APP_ID']
     APP_SECRET = os.environ['APP_SECRET']
     USER_SCOPE = [AuthScope.CHAT_READ, AuthScope.CHAT_EDIT, AuthScope.MODERATOR_MANAGE_BANNED_USERS, AuthScope.CHANNEL_MANAGE_MODERATORS]
-    TARGET_CHANNEL = os.environ['BOT_NAME']
+    TARGET_CHANNEL = os.environ.get('TARGET_CHANNEL', os.environ['BOT_NAME'])
 
     bot = BOT(APP_ID, APP_SECRET, USER_SCOPE, TARGET_CHANNEL)
     asyncio.run(bot.run())
@@ -0,0 +1,297 @@
+import asyncio
+import contextlib
+import contextvars
+import json
+import logging
+import random
+import time
+from collections import deque
+import aiohttp
+from aiohttp.client_exceptions import ClientError
+from metrics import Counter, Gauge, Histogram
+
+log = logging.getLogger(__name__)
+
+HELIX_URL = 'https://api.twitch.tv/helix'
+
+BANNED = 'banned'
+UNBANNED = 'unbanned'
+ALREADY = 'already'
+NOT_FOUND = 'not_found'
+NO_MOD = 'no_mod'
+FAILED = 'failed'
+
+FANOUT = 0
+COMMAND = 1
+BULK = 2
+SHARES = {FANOUT: 0.6, COMMAND: 0.3, BULK: 0.1}
+
+PRIORITY_NAMES = {FANOUT: 'fanout', COMMAND: 'command', BULK: 'bulk'}
+
+PRIORITY = contextvars.ContextVar('priority', default=COMMAND)
+
+HELIX_REQUESTS = Counter('helix_requests_total', 'Helix responses by endpoint and status.')
+HELIX_LATENCY = Histogram('helix_request_seconds', 'Helix request latency by endpoint.')
+RATELIMIT_REMAINING = Gauge('ratelimit_remaining', 'Ratelimit-Remaining from the last Helix response.')
+RATELIMIT_LIMIT = Gauge('ratelimit_limit', 'Ratelimit-Limit from the last Helix response.')
+QUEUE_DEPTH = Gauge('scheduler_queue_depth', 'Requests waiting for a rate-limit token by priority class.')
+
+
+@contextlib.contextmanager
+def priority(level):
+    token = PRIORITY.set(level)
+    try:
+        yield
+    finally:
+        PRIORITY.reset(token)
+
+
+class TokenBucket:
+    # Twitch refills a user token's bucket continuously over a minute; the
+    # Ratelimit-* headers on every response keep our estimate honest.
+    def __init__(self, capacity=800, period=60):
+        self.capacity = capacity
+        self.period = period
+        self.rate = capacity / period
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self.lock = asyncio.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                self.refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def update(self, headers):
+        try:
+            limit = headers.get('Ratelimit-Limit')
+            remaining = headers.get('Ratelimit-Remaining')
+            reset = headers.get('Ratelimit-Reset')
+            if limit is not None:
+                RATELIMIT_LIMIT.set(int(limit))
+            if remaining is not None:
+                RATELIMIT_REMAINING.set(int(remaining))
+            if limit is not None and int(limit) != self.capacity:
+                self.capacity = int(limit)
+                self.rate = self.capacity / self.period
+            if remaining is not None:
+                self.refill()
+                self.tokens = min(self.tokens, float(remaining))
+                if int(remaining) == 0 and reset is not None:
+                    self.pause(int(reset) - time.time())
+        except ValueError:
+            pass
+
+    def pause(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + max(0, seconds))
+
+
+class Scheduler:
+    # Hands out bucket tokens to waiting requests by priority class. Busy
+    # classes split the quota by their share (weighted fair queueing), and
+    # an idle class's share goes to whoever is waiting.
+    def __init__(self, bucket, shares=None):
+        self.bucket = bucket
+        self.shares = dict(shares or SHARES)
+        self.waiting = {level: deque() for level in self.shares}
+        self.finish = dict.fromkeys(self.shares, 0.0)
+        self.clock = 0.0
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    async def acquire(self, level=None):
+        level = PRIORITY.get() if level is None else level
+        future = asyncio.get_running_loop().create_future()
+        if not self.waiting[level]:
+            self.finish[level] = max(self.finish[level], self.clock)
+        self.waiting[level].append(future)
+        QUEUE_DEPTH.set(len(self.waiting[level]), priority=PRIORITY_NAMES.get(level, level))
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.dispatch())
+        self.wakeup.set()
+        await future
+
+    def next_level(self):
+        for queue in self.waiting.values():
+            while queue and queue[0].cancelled():
+                queue.popleft()
+        ready = [level for level, queue in self.waiting.items() if queue]
+        if not ready:
+            return None
+        return min(ready, key=lambda level: (self.finish[level], level))
+
+    async def dispatch(self):
+        while True:
+            if self.next_level() is None:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            await self.bucket.acquire()
+            level = self.next_level()
+            if level is None:
+                continue
+            self.clock = self.finish[level]
+            self.finish[level] += 1 / self.shares[level]
+            self.waiting[level].popleft().set_result(None)
+            QUEUE_DEPTH.set(len(self.waiting[level]), priority=PRIORITY_NAMES.get(level, level))
+
+    def depth(self):
+        return {level: len(queue) for level, queue in self.waiting.items()}
+
+    def close(self):
+        if self.task is not None:
+            self.task.cancel()
+
+
+class BanEngine:
+    def __init__(self, twitch, moderator_id, session=None, workers=10, retries=5, shares=None, helix_url=HELIX_URL):
+        self.twitch = twitch
+        self.moderator_id = moderator_id
+        self.workers = workers
+        self.retries = retries
+        self.bucket = TokenBucket()
+        self.scheduler = Scheduler(self.bucket, shares)
+        self.session = session
+        self.owns_session = session is None
+        self.helix_url = helix_url
+
+    def idle(self, reserve=0.5):
+        # True when nothing is waiting for a token and the bucket is at least
+        # reserve full, so background work only spends quota nobody needs.
+        self.bucket.refill()
+        if time.monotonic() < self.bucket.blocked_until or any(self.scheduler.depth().values()):
+            return False
+        return self.bucket.tokens >= self.bucket.capacity * reserve
+
+    def headers(self):
+        return {
+            'Client-Id': self.twitch.app_id,
+            'Authorization': f'Bearer {self.twitch.get_user_auth_token()}',
+        }
+
+    async def request(self, method, path, params=None, body=None):
+        if self.session is None:
+            self.session = aiohttp.ClientSession()
+        for attempt in range(self.retries):
+            await self.scheduler.acquire()
+            endpoint = f'{method} {path}'
+            start = time.monotonic()
+            try:
+                async with self.session.request(method, f'{self.helix_url}/{path}', params=params, json=body, headers=self.headers()) as response:
+                    HELIX_LATENCY.observe(time.monotonic() - start, endpoint=endpoint)
+                    HELIX_REQUESTS.inc(endpoint=endpoint, status=response.status)
+                    self.bucket.update(response.headers)
+                    if response.status == 401 and attempt == 0:
+                        await self.twitch.refresh_used_token()
+                        continue
+                    if response.status == 401:
+                        log.error('Helix %s still returns 401 after refreshing the token', endpoint)
+                    if response.status == 429:
+                        reset = response.headers.get('Ratelimit-Reset')
+                        self.bucket.pause(int(reset) - time.time() if reset else 2 ** attempt)
+                        continue
+                    if response.status < 500:
+                        text = await response.text()
+                        return response.status, json.loads(text) if text else {}
+                    log.warning('Helix %s returned %s, retrying', endpoint, response.status)
+            except (ClientError, asyncio.TimeoutError, json.JSONDecodeError) as e:
+                HELIX_REQUESTS.inc(endpoint=endpoint, status='error')
+                log.warning('Helix %s failed: %s, retrying', endpoint, e)
+            await asyncio.sleep(min(30, 2 ** attempt) + random.random())
+        return None, None
+
+    async def ban(self, channel_id, user_id, reason='Bot'):
+        params = {'broadcaster_id': channel_id, 'moderator_id': self.moderator_id}
+        body = {'data': {'user_id': user_id, 'reason': reason}}
+        status, data = await self.request('POST', 'moderation/bans', params, body)
+        if status == 200:
+            return BANNED
+        return self.classify(status, data)
+
+    async def unban(self, channel_id, user_id):
+        params = {'broadcaster_id': channel_id, 'moderator_id': self.moderator_id, 'user_id': user_id}
+        status, data = await self.request('DELETE', 'moderation/bans', params)
+        if status == 204:
+            return UNBANNED
+        return self.classify(status, data)
+
+    async def banned_users(self, channel_id):
+        # Pages through Get Banned Users and maps user ID -> ID of the
+        # moderator who issued the ban. None if the list could not be read.
+        banned = {}
+        params = {'broadcaster_id': channel_id, 'first': 100}
+        while True:
+            status, data = await self.request('GET', 'moderation/banned', params)
+            if status != 200:
+                print(f'Failed to read the ban list of channel {channel_id}. Status code: {status}')
+                return None
+            for user in data.get('data', []):
+                banned[user['user_id']] = user.get('moderator_id')
+            cursor = data.get('pagination', {}).get('cursor')
+            if not cursor:
+                return banned
+            params['after'] = cursor
+
+    async def is_moderator(self, channel_id):
+        # True or False when Helix says whether our account may moderate the
+        # channel, None if it could not be asked.
+        status, data = await self.request('GET', 'moderation/banned', {'broadcaster_id': channel_id, 'first': 1})
+        if status == 200:
+            return True
+        if status == 403:
+            return False
+        return None
+
+    def classify(self, status, data):
+        message = (data or {}).get('message', '').lower()
+        # Only 403 means we are not a moderator there. A 401 is our token
+        # failing and must never be taken as a reason to drop a channel.
+        if status == 403:
+            return NO_MOD
+        if status == 400 and ('already banned' in message or 'not banned' in message):
+            return ALREADY
+        if status in (400, 404) and ('not valid' in message or 'not found' in message or 'does not exist' in message):
+            return NOT_FOUND
+        return FAILED
+
+    async def run(self, fn, items, workers=None):
+        # Runs fn over items with several requests in flight; the bucket does
+        # the pacing. A truthy return from fn stops every worker and is returned.
+        items = iter(items)
+        aborted = []
+
+        async def worker():
+            for item in items:
+                if aborted:
+                    return
+                try:
+                    result = await fn(*item)
+                except Exception as e:
+                    log.exception('Error: %s', e)
+                    continue
+                if result:
+                    aborted.append(result)
+                    return
+
+        await asyncio.gather(*(worker() for _ in range(workers or self.workers)))
+        return aborted[0] if aborted else None
+
+    async def close(self):
+        self.scheduler.close()
+        if self.owns_session and self.session is not None:
+            await self.session.close()
+            self.session = None
@@ -0,0 +1,112 @@
+import asyncio
+import codecs
+import json
+import os
+import aiohttp
+from aiohttp.client_exceptions import ClientError
+from json.decoder import JSONDecodeError
+from metrics import Counter, Histogram
+
+FEED_URL = 'https://api.twitchinsights.net/v1/bots/all'
+
+FEED_FETCHES = Counter('feed_fetches_total', 'Bot feed fetches by outcome.')
+FEED_SECONDS = Histogram('feed_fetch_seconds', 'Time to fetch and parse the bot feed.')
+
+
+async def iter_bots(content, chunk_size=64 * 1024):
+    # Streams entries out of the "bots" array of the feed without holding
+    # the whole payload (or its parsed form) in memory at once.
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    in_list = False
+    async for chunk in content.iter_chunked(chunk_size):
+        buffer += text.decode(chunk)
+        if not in_list:
+            start = buffer.find('"bots"')
+            bracket = buffer.find('[', start) if start != -1 else -1
+            if bracket == -1:
+                continue
+            buffer = buffer[bracket + 1:]
+            in_list = True
+        pos = 0
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos < len(buffer) and buffer[pos] == ']':
+                return
+            try:
+                bot, pos = decoder.raw_decode(buffer, pos)
+            except JSONDecodeError:
+                break
+            yield bot
+        buffer = buffer[pos:]
+    if not in_list:
+        raise JSONDecodeError('No bots list in the response', buffer, 0)
+
+
+class BotFeed:
+    def __init__(self, session, url=FEED_URL, snapshot_file='feed.json'):
+        self.session = session
+        self.url = url
+        self.snapshot_path = os.path.join('data', snapshot_file)
+        self.etag = None
+        self.last_modified = None
+        self.bots = []
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.snapshot_path, 'r') as file:
+                snapshot = json.load(file)
+            self.etag = snapshot.get('etag')
+            self.last_modified = snapshot.get('last_modified')
+            self.bots = snapshot.get('bots', [])
+        except FileNotFoundError:
+            pass
+        except JSONDecodeError:
+            print(f'Error: Could not decode {self.snapshot_path}, the next fetch will be a full one')
+
+    def save(self):
+        tmp_path = f'{self.snapshot_path}.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump({'etag': self.etag, 'last_modified': self.last_modified, 'bots': self.bots}, file, ensure_ascii=False)
+        os.replace(tmp_path, self.snapshot_path)
+
+    async def fetch(self):
+        # Returns (bots, changed). An unchanged feed costs one 304 and hands
+        # back the snapshot; None for bots means the fetch failed.
+        with FEED_SECONDS.time():
+            bots, changed = await self.fetch_feed()
+        FEED_FETCHES.inc(result='failed' if bots is None else 'changed' if changed else 'unchanged')
+        return bots, changed
+
+    async def fetch_feed(self):
+        headers = {}
+        if self.bots and self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.bots and self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        try:
+            async with self.session.get(self.url, headers=headers) as response:
+                if response.status == 304:
+                    return self.bots, False
+                response.raise_for_status()
+                bots = [bot async for bot in iter_bots(response.content)]
+                self.etag = response.headers.get('ETag')
+                self.last_modified = response.headers.get('Last-Modified')
+        except aiohttp.ClientResponseError as e:
+            print(f'HTTP Error: {e.status} for URL {e.request_info.url}')
+            return None, False
+        except ClientError as e:
+            print(f'Client Error: {e}')
+            return None, False
+        except JSONDecodeError:
+            print('Failed to decode JSON from response')
+            return None, False
+        except Exception as e:
+            print(f'Unexpected error: {e}')
+            return None, False
+        self.bots = bots
+        await asyncio.to_thread(self.save)
+        return bots, True
@@ -1,14 +1,40 @@
-import openai
+import asyncio
+import importlib
+import json
 import os
-from retrying import retry
 from dotenv import load_dotenv
 
 load_dotenv(dotenv_path=os.path.join('config', '.env'))
 
-openai.api_key = os.environ['API_KEY']
+_client = None
 
 
-@retry(stop_max_attempt_number=3, wait_fixed=2000)
-def create_prompt(prompt):
-    print('attempting to create a prompt')
-    return openai.chat.completions.create(model="gpt-3.5-turbo", messages=[{"role": "user", "content": f"In less than 60 words, please write a limerick about a bot named {prompt} that got banned from Twitch."}], temperature=1.2)
\ No newline at end of file
+async def get_client():
+    # The openai package is slow to import, so it is loaded in a thread the
+    # first time a limerick is needed instead of when the bot starts.
+    global _client
+    if _client is None:
+        openai = await asyncio.to_thread(importlib.import_module, 'openai')
+        _client = openai.AsyncOpenAI(api_key=os.environ['API_KEY'])
+    return _client
+
+
+async def create_limericks(names, attempts=3, wait=2):
+    # One completion for the whole batch; the model answers with a JSON
+    # object mapping each bot name to its limerick.
+    names = list(names)
+    prompt = (f"For each of these bots that got banned from Twitch, write a limerick about the bot in less than 60 words: {', '.join(names)}. "
+              "Reply with a JSON object that maps each bot name to its limerick.")
+    for attempt in range(attempts):
+        try:
+            print(f'attempting to create limericks for {len(names)} bots')
+            client = await get_client()
+            completion = await client.chat.completions.create(model="gpt-3.5-turbo", messages=[{"role": "user", "content": prompt}], temperature=1.2,
+                                                              response_format={"type": "json_object"})
+            stories = json.loads(completion.choices[0].message.content)
+            return {name: str(stories[name]) for name in names if stories.get(name)}
+        except Exception as e:
+            print(f'Error creating limericks: {e}')
+            if attempt + 1 < attempts:
+                await asyncio.sleep(wait)
+    return {}
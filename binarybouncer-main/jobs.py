@@ -0,0 +1,79 @@
+import asyncio
+from collections import namedtuple
+
+Job = namedtuple('Job', 'id channel channel_id action size', defaults=(None,))
+
+
+class JobQueue:
+    # Mass ban/unban jobs live in the store with one row per bot, so a job
+    # that dies with the process picks up at the first unconfirmed bot.
+    def __init__(self, state, handler):
+        self.state = state
+        self.handler = handler
+        self.tasks = {}
+
+    async def submit(self, channel, channel_id, action, bots):
+        self.cancel(channel_id)
+        job_id, size = await self.state.call('create_job', channel, channel_id, action, bots)
+        job = Job(job_id, channel, str(channel_id), action, size)
+        print(f'Queued {action} job {job.id} on {channel}\'s channel for {size} bots')
+        self.start(job)
+        return job
+
+    def cancel(self, channel_id):
+        # Jobs that are not running here (failed, or owned by another shard)
+        # are still open in the store and must not resume later either.
+        for job, task in list(self.tasks.values()):
+            if job.channel_id == str(channel_id):
+                print(f'Cancelling {job.action} job {job.id} on {job.channel}\'s channel')
+                task.cancel()
+        self.state.defer('cancel_jobs', channel_id)
+
+    async def resume(self, owns=None):
+        for row in await self.state.call('open_jobs'):
+            job = Job(*row)
+            if job.id in self.tasks or (owns is not None and not owns(job.channel)):
+                continue
+            if not await self.state.call('has_channel', job.channel):
+                print(f'Cancelling {job.action} job {job.id} on {job.channel}\'s channel, it is no longer protected')
+                self.state.defer('finish_job', job.id, 'cancelled')
+            else:
+                done, total = await self.state.call('job_progress', job.id)
+                print(f'Resuming {job.action} job {job.id} on {job.channel}\'s channel ({done or 0}/{total} done)')
+                self.start(job)
+
+    def release(self, owns):
+        # Stops jobs for channels another shard now owns without finishing
+        # them, so the new owner resumes them from the store.
+        for job, task in list(self.tasks.values()):
+            if not owns(job.channel):
+                print(f'Handing {job.action} job {job.id} on {job.channel}\'s channel to another shard')
+                task.cancel()
+
+    async def stop(self):
+        # Stops every running job without finishing it. Confirmed bots are
+        # already checkpointed, so the jobs resume from there on restart.
+        tasks = [task for job, task in self.tasks.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def start(self, job):
+        self.tasks[job.id] = (job, asyncio.create_task(self.execute(job)))
+
+    async def execute(self, job):
+        try:
+            await self.handler(job)
+            self.state.defer('finish_job', job.id, 'done')
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f'Error running {job.action} job {job.id} on {job.channel}\'s channel, will retry on restart: {e}')
+        finally:
+            self.tasks.pop(job.id, None)
+
+    async def pending(self, job):
+        return await self.state.call('pending_items', job.id)
+
+    def done(self, job, name):
+        self.state.defer('mark_done', job.id, name)
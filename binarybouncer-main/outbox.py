@@ -0,0 +1,114 @@
+import asyncio
+import time
+from collections import deque
+from engine import TokenBucket
+from metrics import Counter, Gauge
+
+MOD_LIMIT = 100
+USER_LIMIT = 20
+LIMIT_PERIOD = 30
+REPLY_TTL = 60
+BROADCAST_TTL = 300
+MAX_QUEUED = 200
+
+CHAT_SENT = Counter('chat_messages_total', 'Chat messages by outcome (sent, dropped, expired, failed).')
+CHAT_DEPTH = Gauge('chat_queue_depth', 'Chat messages waiting to be sent.')
+
+
+class ChatOutbox:
+    # Every outgoing chat message goes through here: one bucket sized for
+    # Twitch's chat limits, per-channel pacing, and replies ahead of broadcasts.
+    def __init__(self, send, moderator=True, channel_interval=None, max_queued=MAX_QUEUED):
+        self.send = send
+        self.bucket = TokenBucket(MOD_LIMIT if moderator else USER_LIMIT, LIMIT_PERIOD)
+        self.channel_interval = channel_interval if channel_interval is not None else (0.3 if moderator else 1.0)
+        self.max_queued = max_queued
+        self.replies = deque()
+        self.broadcasts = deque()
+        self.next_send = {}
+        self.dropped = 0
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    def reply(self, channel, text):
+        return self.submit(self.replies, channel, text, REPLY_TTL)
+
+    def broadcast(self, channel, text):
+        return self.submit(self.broadcasts, channel, text, BROADCAST_TTL)
+
+    def submit(self, queue, channel, text, ttl):
+        if any(queued[0] == channel and queued[1] == text for queued in queue):
+            return True
+        if self.depth() >= self.max_queued:
+            if queue is self.replies and self.broadcasts:
+                self.broadcasts.popleft()
+            else:
+                self.dropped += 1
+                CHAT_SENT.inc(result='dropped')
+                print(f'Chat outbox full ({self.depth()} queued), dropping message to {channel}')
+                return False
+        queue.append((channel, text, time.monotonic() + ttl))
+        CHAT_DEPTH.set(self.depth())
+        self.wakeup.set()
+        return True
+
+    def depth(self):
+        return len(self.replies) + len(self.broadcasts)
+
+    def next_message(self):
+        # First sendable message, replies first. Returns (message, wait) where
+        # wait is how long until some queued channel may be sent to again.
+        now = time.monotonic()
+        wait = None
+        for queue in (self.replies, self.broadcasts):
+            for message in list(queue):
+                channel, text, deadline = message
+                if deadline < now:
+                    queue.remove(message)
+                    self.dropped += 1
+                    CHAT_SENT.inc(result='expired')
+                    continue
+                ready_at = self.next_send.get(channel, 0)
+                if ready_at <= now:
+                    queue.remove(message)
+                    return message, None
+                wait = ready_at - now if wait is None else min(wait, ready_at - now)
+        return None, wait
+
+    async def run(self):
+        while True:
+            message, wait = self.next_message()
+            if message is None:
+                self.wakeup.clear()
+                if wait is None:
+                    await self.wakeup.wait()
+                else:
+                    try:
+                        await asyncio.wait_for(self.wakeup.wait(), wait)
+                    except asyncio.TimeoutError:
+                        pass
+                continue
+            channel, text, deadline = message
+            await self.bucket.acquire()
+            self.next_send[channel] = time.monotonic() + self.channel_interval
+            CHAT_DEPTH.set(self.depth())
+            try:
+                await self.send(channel, text)
+                CHAT_SENT.inc(result='sent')
+            except Exception as e:
+                CHAT_SENT.inc(result='failed')
+                print(f'Error sending message to {channel}: {e}')
+
+    async def drain(self, timeout):
+        # Gives queued replies a chance to go out before shutting down.
+        deadline = time.monotonic() + timeout
+        while self.replies and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+
+    def close(self):
+        if self.task is not None:
+            self.task.cancel()
@@ -0,0 +1,103 @@
+import asyncio
+import time
+from metrics import Gauge
+
+MIN_INTERVAL = 60
+MAX_INTERVAL = 900
+BACKOFF = 1.5
+
+POLL_INTERVAL = Gauge('ban_routine_interval_seconds', 'Current wait between ban_routine runs.')
+POLL_NEXT_RUN = Gauge('ban_routine_next_run_timestamp', 'Unix time of the next scheduled ban_routine run.')
+POLL_LAST_DURATION = Gauge('ban_routine_last_duration_seconds', 'Duration of the last ban_routine run.')
+
+
+class Poller:
+    # Runs routine on an adaptive schedule. routine returns how many new bots
+    # it found (None if it failed): a find drops the wait to min_interval so
+    # the rest of a wave is caught quickly, and every quiet run stretches it
+    # by backoff up to max_interval. Runs never overlap.
+    def __init__(self, routine, min_interval=MIN_INTERVAL, max_interval=MAX_INTERVAL, backoff=BACKOFF):
+        self.routine = routine
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.interval = max_interval
+        self.next_run = time.time()
+        self.last_run = None
+        self.last_duration = None
+        self.last_found = None
+        self.lock = asyncio.Lock()
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    def trigger(self):
+        # Runs the routine as soon as the current run (if any) is over.
+        self.next_run = time.time()
+        self.wakeup.set()
+
+    def schedule(self):
+        return {
+            'interval': self.interval,
+            'next_run': self.next_run,
+            'last_run': self.last_run,
+            'last_duration': self.last_duration,
+            'last_found': self.last_found,
+            'running': self.lock.locked(),
+        }
+
+    def adjust(self, found):
+        if found:
+            self.interval = self.min_interval
+        elif found is not None:
+            self.interval = min(self.max_interval, self.interval * self.backoff)
+
+    async def run_once(self):
+        if self.lock.locked():
+            print('Ban routine already running, skipping this run')
+            return None
+        async with self.lock:
+            start = time.monotonic()
+            self.last_run = time.time()
+            try:
+                found = await self.routine()
+            except Exception as e:
+                print(f'Error running the ban routine: {e}')
+                found = None
+            self.last_duration = time.monotonic() - start
+            self.last_found = found
+        self.adjust(found)
+        self.next_run = time.time() + self.interval
+        POLL_INTERVAL.set(self.interval)
+        POLL_NEXT_RUN.set(self.next_run)
+        POLL_LAST_DURATION.set(self.last_duration)
+        print(f'Ban routine took {self.last_duration:.1f}s, next run in {self.interval:.0f}s')
+        return found
+
+    async def run(self):
+        while True:
+            delay = self.next_run - time.time()
+            if delay > 0:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self.run_once()
+
+    async def stop(self, timeout):
+        # Lets a run in progress finish, so a wave being fanned out is not cut
+        # short, for up to timeout seconds before cancelling it.
+        try:
+            await asyncio.wait_for(self.lock.acquire(), timeout)
+        except asyncio.TimeoutError:
+            print(f'Ban routine still running after {timeout}s, stopping it')
+        self.close()
+
+    def close(self):
+        if self.task is not None:
+            self.task.cancel()
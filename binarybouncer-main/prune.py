@@ -0,0 +1,109 @@
+import asyncio
+import itertools
+import time
+from engine import priority, BULK
+from metrics import Counter, Gauge
+
+BATCH_SIZE = 100
+ALIVE_INTERVAL = 6 * 60 * 60
+DEAD_INTERVAL = 24 * 60 * 60
+PACE = 1
+
+REVALIDATED = Counter('revalidated_bots_total', 'Bots checked by revalidation by outcome (alive, suspended, reactivated).')
+SWEEP_SECONDS = Gauge('revalidation_sweep_seconds', 'Duration of the last revalidation sweep by list.')
+
+
+class Pruner:
+    # Re-checks the alive list by user ID in batches of 100, only while the
+    # engine has quota to spare, and moves accounts Twitch no longer returns
+    # to the dead set. The dead set is swept less often for reactivations.
+    # Sweep times are kept in the counters so restarts do not re-sweep.
+    def __init__(self, state, resolver, engine, alive_interval=ALIVE_INTERVAL, dead_interval=DEAD_INTERVAL, pace=PACE):
+        self.state = state
+        self.resolver = resolver
+        self.engine = engine
+        self.alive_interval = alive_interval
+        self.dead_interval = dead_interval
+        self.pace = pace
+        self.task = None
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    def due(self, key, interval):
+        last = self.state.counters.get(key)
+        return not last or time.time() - float(last) >= interval
+
+    async def run(self):
+        while True:
+            try:
+                if self.due('lastAliveSweep', self.alive_interval):
+                    await self.sweep_alive()
+                elif self.due('lastDeadSweep', self.dead_interval):
+                    await self.sweep_dead()
+                else:
+                    await asyncio.sleep(60)
+            except Exception as e:
+                print(f'Error revalidating bots, will retry: {e}')
+                await asyncio.sleep(60)
+
+    async def wait_idle(self):
+        while not self.engine.idle():
+            await asyncio.sleep(self.pace)
+
+    async def batches(self, bots):
+        # Streams (name, user ID) pairs and yields (by_id, found, missing) per
+        # batch of bots that have an ID.
+        pairs = ((name, user_id) for name, user_id in bots if user_id)
+        while chunk := list(itertools.islice(pairs, BATCH_SIZE)):
+            by_id = {str(user_id): name for name, user_id in chunk}
+            await self.wait_idle()
+            with priority(BULK):
+                found, missing = await self.resolver.check_ids(list(by_id))
+            yield by_id, found, missing
+            await asyncio.sleep(self.pace)
+
+    async def sweep_alive(self):
+        start = time.monotonic()
+        total = len(self.state.alive)
+        suspended = 0
+        async for by_id, found, missing in self.batches(self.state.alive.items()):
+            REVALIDATED.inc(len(found), result='alive')
+            gone = {by_id[user_id]: user_id for user_id in missing if self.state.alive.get(by_id[user_id]) == user_id}
+            if gone:
+                self.state.del_bots(gone)
+                suspended += len(gone)
+                REVALIDATED.inc(len(gone), result='suspended')
+        self.state.set_counter('lastAliveSweep', time.time())
+        SWEEP_SECONDS.set(time.monotonic() - start, list='alive')
+        print(f'Revalidated {total} alive bots, {suspended} moved to the dead bots')
+
+    async def sweep_dead(self):
+        start = time.monotonic()
+        bots = dict(self.state.dead)
+        reactivated = 0
+        async for by_id, found, missing in self.batches(bots.items()):
+            back = {by_id[user_id]: user_id for user_id in found if by_id[user_id] in self.state.dead}
+            if back:
+                self.state.add_bots(back)
+                reactivated += len(back)
+        # Bots that never resolved have no ID to check, so look them up by login.
+        names = [name for name, user_id in bots.items() if not user_id]
+        for start_index in range(0, len(names), BATCH_SIZE):
+            await self.wait_idle()
+            with priority(BULK):
+                found, missing = await self.resolver.resolve(names[start_index:start_index + BATCH_SIZE], use_cache=False)
+            back = {name: user_id for name, user_id in found.items() if name in self.state.dead}
+            if back:
+                self.state.add_bots(back)
+                reactivated += len(back)
+            await asyncio.sleep(self.pace)
+        REVALIDATED.inc(reactivated, result='reactivated')
+        self.state.set_counter('lastDeadSweep', time.time())
+        SWEEP_SECONDS.set(time.monotonic() - start, list='dead')
+        print(f'Revalidated {len(bots)} dead bots, {reactivated} moved back to the alive bots')
+
+    def close(self):
+        if self.task is not None:
+            self.task.cancel()
@@ -0,0 +1,101 @@
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+MAGIC = b'BBR1'
+HEADER = struct.Struct('<4sQQ16s')
+
+
+class BotRegistry:
+    # Name -> user ID map for the alive bots, kept as interned names and an
+    # array of integer IDs indexed by slot. Removed bots leave an empty slot
+    # until the next save, so slots never move and items() can stream while
+    # bots are added or removed (including from the store thread).
+    def __init__(self, bots=()):
+        self.names = []
+        self.ids = array('Q')
+        self.index = {}
+        self.update(bots)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __iter__(self):
+        return (name for name, user_id in self.items())
+
+    def __getitem__(self, name):
+        return str(self.ids[self.index[name]])
+
+    def __delitem__(self, name):
+        slot = self.index.pop(name)
+        self.names[slot] = None
+
+    def get(self, name, default=None):
+        slot = self.index.get(name)
+        return default if slot is None else str(self.ids[slot])
+
+    def pop(self, name, default=None):
+        slot = self.index.pop(name, None)
+        if slot is None:
+            return default
+        self.names[slot] = None
+        return str(self.ids[slot])
+
+    def update(self, bots):
+        for name, user_id in bots.items() if hasattr(bots, 'items') else bots:
+            # Convert first so a bad ID cannot leave names and ids out of step.
+            user_id = int(user_id)
+            slot = self.index.get(name)
+            if slot is None:
+                self.ids.append(user_id)
+                name = sys.intern(name)
+                self.names.append(name)
+                self.index[name] = len(self.names) - 1
+            else:
+                self.ids[slot] = user_id
+
+    def items(self):
+        for slot in range(len(self.names)):
+            name = self.names[slot]
+            if name is not None:
+                yield name, str(self.ids[slot])
+
+    def save(self, path, version):
+        names = [name for name in self.names if name is not None]
+        ids = array('Q', (self.ids[self.index[name]] for name in names))
+        blob = '\n'.join(names).encode()
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as file:
+            file.write(HEADER.pack(MAGIC, len(names), len(blob), version.encode()))
+            ids.tofile(file)
+            file.write(blob)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, version):
+        # Returns None unless the snapshot exists and was written for this
+        # version of the alive list.
+        try:
+            with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as view:
+                magic, count, size, saved = HEADER.unpack_from(view, 0)
+                if magic != MAGIC or saved.decode() != version:
+                    return None
+                registry = cls()
+                offset = HEADER.size + count * registry.ids.itemsize
+                registry.ids.frombytes(view[HEADER.size:offset])
+                if count:
+                    registry.names = [sys.intern(name) for name in view[offset:offset + size].decode().split('\n')]
+        except (OSError, ValueError, struct.error) as e:
+            if not isinstance(e, FileNotFoundError):
+                print(f'Error: Could not load {path}: {e}')
+            return None
+        if len(registry.names) != len(registry.ids):
+            print(f'Error: {path} is corrupt, rebuilding it from the database')
+            return None
+        registry.index = {name: slot for slot, name in enumerate(registry.names)}
+        return registry
@@ -0,0 +1,78 @@
+import asyncio
+import time
+
+BATCH_SIZE = 100
+CACHE_TTL = 7 * 24 * 60 * 60
+
+
+class UserResolver:
+    def __init__(self, engine, state, ttl=CACHE_TTL):
+        self.engine = engine
+        self.state = state
+        self.ttl = ttl
+
+    async def resolve(self, names, use_cache=True):
+        # Returns (found, missing): found maps login -> user ID, missing lists
+        # logins Twitch does not know. Logins whose lookup failed are in neither.
+        now = time.time()
+        found, missing, pending = {}, [], []
+        names = list(dict.fromkeys(name.lower() for name in names))
+        cache = await self.state.call('cached_ids', names) if use_cache else {}
+        for name in names:
+            entry = cache.get(name)
+            if use_cache and entry and now - entry[1] < self.ttl:
+                if entry[0] is None:
+                    missing.append(name)
+                else:
+                    found[name] = entry[0]
+            else:
+                pending.append(name)
+        if not pending:
+            return found, missing
+        chunks = [pending[i:i + BATCH_SIZE] for i in range(0, len(pending), BATCH_SIZE)]
+        results = await asyncio.gather(*(self.fetch(chunk) for chunk in chunks))
+        resolved = {}
+        for chunk, ids in zip(chunks, results):
+            if ids is None:
+                continue
+            for name in chunk:
+                user_id = ids.get(name)
+                resolved[name] = user_id
+                if user_id is None:
+                    missing.append(name)
+                else:
+                    found[name] = user_id
+        self.state.defer('cache_ids', resolved, now)
+        return found, missing
+
+    async def check_ids(self, user_ids):
+        # Returns (found, missing) for user IDs: found maps ID -> current
+        # login, missing lists IDs Twitch no longer returns (suspended or
+        # deleted). IDs whose lookup failed are in neither.
+        user_ids = list(dict.fromkeys(str(user_id) for user_id in user_ids))
+        chunks = [user_ids[i:i + BATCH_SIZE] for i in range(0, len(user_ids), BATCH_SIZE)]
+        results = await asyncio.gather(*(self.fetch_ids(chunk) for chunk in chunks))
+        found, missing = {}, []
+        for chunk, logins in zip(chunks, results):
+            if logins is None:
+                continue
+            for user_id in chunk:
+                if user_id in logins:
+                    found[user_id] = logins[user_id]
+                else:
+                    missing.append(user_id)
+        return found, missing
+
+    async def fetch_ids(self, user_ids):
+        status, data = await self.engine.request('GET', 'users', [('id', user_id) for user_id in user_ids])
+        if status != 200:
+            print(f'Failed to look up {len(user_ids)} user IDs. Status code: {status}')
+            return None
+        return {user['id']: user['login'] for user in data.get('data', [])}
+
+    async def fetch(self, logins):
+        status, data = await self.engine.request('GET', 'users', [('login', login) for login in logins])
+        if status != 200:
+            print(f'Failed to resolve {len(logins)} users. Status code: {status}')
+            return None
+        return {user['login']: user['id'] for user in data.get('data', [])}
@@ -0,0 +1,208 @@
+import asyncio
+import bisect
+import hashlib
+import json
+
+SHARD_HOST = '127.0.0.1'
+SHARD_PORT = 8765
+REPLICAS = 100
+LINE_LIMIT = 2 ** 24
+
+
+class HashRing:
+    def __init__(self, nodes=(), replicas=REPLICAS):
+        self.replicas = replicas
+        self.nodes = set()
+        self.hashes = []
+        self.owners = []
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def hash(key):
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+    def add(self, node):
+        if node in self.nodes:
+            return
+        self.nodes.add(node)
+        for i in range(self.replicas):
+            point = self.hash(f'{node}#{i}')
+            index = bisect.bisect(self.hashes, point)
+            self.hashes.insert(index, point)
+            self.owners.insert(index, node)
+
+    def remove(self, node):
+        if node not in self.nodes:
+            return
+        self.nodes.discard(node)
+        keep = [i for i, owner in enumerate(self.owners) if owner != node]
+        self.hashes = [self.hashes[i] for i in keep]
+        self.owners = [self.owners[i] for i in keep]
+
+    def owner(self, key, exclude=()):
+        # Walks the ring from the key's point to the first node not in
+        # exclude, so excluding a node moves only that key. None if every
+        # node is excluded.
+        if not self.hashes:
+            return None
+        start = bisect.bisect(self.hashes, self.hash(key))
+        for i in range(len(self.owners)):
+            owner = self.owners[(start + i) % len(self.owners)]
+            if owner not in exclude:
+                return owner
+        return None
+
+
+async def write_message(writer, message):
+    writer.write((json.dumps(message) + '\n').encode())
+    await writer.drain()
+
+
+class ShardCoordinator:
+    # Runs in the process that owns the feed. Workers connect over a local
+    # socket, and every membership change is announced so shards rebalance.
+    # Messages from workers go to on_message(shard, message). A channel skips
+    # the shards that turned out not to be moderators there (unmodded).
+    def __init__(self, name, on_members, on_message=None, host=SHARD_HOST, port=SHARD_PORT):
+        self.name = name
+        self.on_members = on_members
+        self.on_message = on_message
+        self.host = host
+        self.port = port
+        self.ring = HashRing([name])
+        self.unmodded = {}
+        self.peers = {}
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port, limit=LINE_LIMIT)
+        print(f'Shard coordinator listening on {self.host}:{self.port}')
+
+    async def handle(self, reader, writer):
+        try:
+            hello = json.loads(await reader.readline())
+            name = hello['shard']
+        except (ValueError, KeyError) as e:
+            print(f'Rejected shard connection: {e}')
+            writer.close()
+            return
+        print(f'Shard {name} joined')
+        self.peers[name] = writer
+        self.ring.add(name)
+        await self.announce()
+        try:
+            while line := await reader.readline():
+                if self.on_message is not None:
+                    try:
+                        await self.on_message(name, json.loads(line))
+                    except Exception as e:
+                        print(f'Error handling message from shard {name}: {e}')
+        except ConnectionError:
+            pass
+        finally:
+            if self.peers.get(name) is writer:
+                del self.peers[name]
+                self.ring.remove(name)
+                print(f'Shard {name} left')
+                await self.announce()
+            writer.close()
+
+    async def announce(self):
+        unmodded = {key: sorted(names) for key, names in self.unmodded.items()}
+        await self.broadcast({'type': 'members', 'shards': sorted(self.ring.nodes), 'unmodded': unmodded})
+        self.on_members()
+
+    async def exclude(self, key, name):
+        # Moves key off a shard that cannot work on it and returns the new
+        # owner, or None when no shard is left for it.
+        self.unmodded.setdefault(key, set()).add(name)
+        await self.announce()
+        return self.owner(key)
+
+    async def reset(self, key):
+        if self.unmodded.pop(key, None):
+            await self.announce()
+
+    async def broadcast(self, message):
+        for name in list(self.peers):
+            await self.send(name, message)
+
+    async def send(self, name, message):
+        writer = self.peers.get(name)
+        if writer is None:
+            return False
+        try:
+            await write_message(writer, message)
+            return True
+        except ConnectionError as e:
+            print(f'Error sending to shard {name}: {e}')
+            return False
+
+    def owner(self, key):
+        return self.ring.owner(key, self.unmodded.get(key, ()))
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        for writer in self.peers.values():
+            writer.close()
+
+
+class ShardWorker:
+    # Connects to the coordinator and hands every message to handler. The
+    # last known ring is kept while disconnected so protection continues.
+    def __init__(self, name, handler, host=SHARD_HOST, port=SHARD_PORT, retry=5):
+        self.name = name
+        self.handler = handler
+        self.host = host
+        self.port = port
+        self.retry = retry
+        self.ring = HashRing()
+        self.unmodded = {}
+        self.tasks = set()
+        self.writer = None
+
+    async def dispatch(self, message):
+        try:
+            await self.handler(message)
+        except Exception as e:
+            print(f'Error handling shard message {message["type"]}: {e}')
+
+    async def run(self):
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(self.host, self.port, limit=LINE_LIMIT)
+                await write_message(writer, {'shard': self.name})
+                self.writer = writer
+                print(f'Shard {self.name} connected to the coordinator')
+                while line := await reader.readline():
+                    message = json.loads(line)
+                    if message['type'] == 'members':
+                        self.ring = HashRing(message['shards'])
+                        self.unmodded = {key: set(names) for key, names in message.get('unmodded', {}).items()}
+                        await self.dispatch(message)
+                    else:
+                        task = asyncio.create_task(self.dispatch(message))
+                        self.tasks.add(task)
+                        task.add_done_callback(self.tasks.discard)
+                writer.close()
+            except (ConnectionError, OSError) as e:
+                print(f'Shard {self.name} lost the coordinator: {e}')
+            self.writer = None
+            await asyncio.sleep(self.retry)
+
+    async def send(self, message):
+        if self.writer is None:
+            print(f'Shard {self.name} is not connected, dropping {message["type"]} message')
+            return False
+        try:
+            await write_message(self.writer, message)
+            return True
+        except ConnectionError as e:
+            print(f'Error sending to the coordinator: {e}')
+            return False
+
+    def owner(self, key):
+        return self.ring.owner(key, self.unmodded.get(key, ()))
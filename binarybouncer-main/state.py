@@ -0,0 +1,196 @@
+import asyncio
+import os
+import secrets
+from concurrent.futures import ThreadPoolExecutor
+from registry import BotRegistry
+from store import Store
+
+FLUSH_INTERVAL = 2
+SNAPSHOT_FILE = 'alivebots.bin'
+# Changes that are also kept in memory, by the name of the method making them.
+IN_MEMORY = {'add_bots', 'del_bots', 'add_channel', 'remove_channel', 'add_limerick', 'del_limerick', 'add_known', 'increment', 'set_counter'}
+
+
+class State:
+    # Channels, bots, limerick subscribers and counters live in memory for
+    # O(1) lookups from chat commands. Every change is also queued and
+    # written behind to the store in one transaction on the store's own
+    # thread, so the event loop never waits on disk.
+    def __init__(self, store=None):
+        self.store = store or Store()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='store')
+        self.changes = []
+        self.lock = asyncio.Lock()
+        self.task = None
+        self.load()
+
+    @classmethod
+    async def open(cls):
+        return await asyncio.to_thread(cls)
+
+    def load(self):
+        *data, self.known = self.read()
+        self.assign(*data)
+
+    def read(self):
+        # Reads everything kept in memory without touching self, so it can run
+        # on the store thread while the event loop keeps using the old data.
+        counters = self.store.counters()
+        return counters, self.load_alive(counters), self.store.dead_bots(), self.store.channels(), set(self.store.limerick()), set(self.store.known_names())
+
+    def assign(self, counters, alive, dead, channels, limerick):
+        self.counters = counters
+        self.alive = alive
+        self.dead = dead
+        self.channels = channels
+        self.channel_names = {str(channel_id): channel for channel, channel_id in channels.items()}
+        self.limerick = limerick
+
+    def load_alive(self, counters):
+        # The alive list loads from a binary snapshot when its version matches
+        # the one in the store (every process that changes the list writes a
+        # new one), otherwise from the store, after which the snapshot is redone.
+        path = os.path.join(self.store.data_dir, SNAPSHOT_FILE)
+        version = counters.get('aliveVersion')
+        alive = BotRegistry.load(path, version) if version else None
+        if alive is None:
+            alive = BotRegistry(self.store.alive_bots())
+            if not version:
+                version = counters['aliveVersion'] = secrets.token_hex(8)
+                self.store.set_counter('aliveVersion', version)
+            alive.save(path, version)
+        return alive
+
+    def save_alive(self):
+        # Other shards may have changed the list since this process last read
+        # it, so the snapshot is taken from the store with the store's version.
+        with self.store.transaction():
+            version = self.store.get_counter('aliveVersion')
+            alive = BotRegistry(self.store.alive_bots())
+        alive.save(os.path.join(self.store.data_dir, SNAPSHOT_FILE), version)
+
+    def defer(self, method, *args):
+        self.changes.append((method, args))
+
+    async def flush(self):
+        async with self.lock:
+            if not self.changes:
+                return
+            changes, self.changes = self.changes, []
+            try:
+                await asyncio.get_running_loop().run_in_executor(self.executor, self.store.apply, changes)
+            except Exception as e:
+                print(f'Error flushing {len(changes)} changes to the store, will retry: {e}')
+                self.changes[:0] = changes
+
+    async def call(self, method, *args):
+        # Runs a store method on the store thread after everything queued so
+        # far has been written, for data that is not kept in memory.
+        await self.flush()
+        return await asyncio.get_running_loop().run_in_executor(self.executor, getattr(self.store, method), *args)
+
+    async def reload(self):
+        # Picks up changes other processes (shards) wrote to the store. The
+        # known set is refilled in place since the feed index holds on to it.
+        # Nothing is flushed while the store is read, so every queued change
+        # (including ones made during the read) is missing from what was read
+        # and is applied to it again.
+        await self.flush()
+        async with self.lock:
+            *data, known = await asyncio.get_running_loop().run_in_executor(self.executor, self.read)
+            self.assign(*data)
+            self.known.clear()
+            self.known.update(known)
+            self.replay(self.changes)
+
+    def replay(self, changes):
+        # Makes the changes in memory again without queueing them twice.
+        self.changes = []
+        for method, args in changes:
+            if method in IN_MEMORY:
+                getattr(self, method)(*args)
+        self.changes = changes
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            await self.flush()
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+        await self.flush()
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.save_alive)
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.store.close)
+        self.executor.shutdown()
+
+    def touch_alive(self):
+        self.set_counter('aliveVersion', secrets.token_hex(8))
+
+    def add_bots(self, bots):
+        bots = {name: user_id for name, user_id in bots.items() if user_id is not None}
+        self.alive.update(bots)
+        for name in bots:
+            self.dead.pop(name, None)
+        self.defer('add_bots', dict(bots))
+        self.touch_alive()
+
+    def del_bots(self, bots):
+        removed = [name for name in bots if name in self.alive]
+        for name in removed:
+            del self.alive[name]
+        self.dead.update(bots)
+        self.defer('del_bots', dict(bots))
+        if removed:
+            self.touch_alive()
+        return removed
+
+    def add_channel(self, channel, channel_id):
+        if channel in self.channels:
+            return False
+        self.channels[channel] = channel_id
+        self.channel_names[str(channel_id)] = channel
+        self.defer('add_channel', channel, channel_id)
+        return True
+
+    def remove_channel(self, channel_id):
+        channel = self.channel_names.pop(str(channel_id), None)
+        if channel is None:
+            return None
+        self.channels.pop(channel, None)
+        self.defer('remove_channel', channel_id)
+        return channel
+
+    def add_limerick(self, name):
+        if name in self.limerick:
+            return False
+        self.limerick.add(name)
+        self.defer('add_limerick', name)
+        return True
+
+    def del_limerick(self, name):
+        if name not in self.limerick:
+            return False
+        self.limerick.discard(name)
+        self.defer('del_limerick', name)
+        return True
+
+    def add_known(self, names):
+        names = [name for name in names if name not in self.known]
+        self.known.update(names)
+        self.defer('add_known', names)
+
+    def increment(self, key, amount=1):
+        # The store adds the amount in SQL, so shards sharing the database do
+        # not overwrite each other's counts; the local value is only for display.
+        self.counters[key] = (self.counters.get(key) or 0) + amount
+        self.defer('increment', key, amount)
+        return self.counters[key]
+
+    def set_counter(self, key, value):
+        self.counters[key] = value
+        self.defer('set_counter', key, value)
@@ -0,0 +1,243 @@
+import contextlib
+import json
+import os
+import sqlite3
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS alive_bots (name TEXT PRIMARY KEY, id TEXT);
+CREATE INDEX IF NOT EXISTS alive_bots_id ON alive_bots (id);
+CREATE TABLE IF NOT EXISTS dead_bots (name TEXT PRIMARY KEY, id TEXT);
+CREATE TABLE IF NOT EXISTS channels (name TEXT PRIMARY KEY, id TEXT);
+CREATE INDEX IF NOT EXISTS channels_id ON channels (id);
+CREATE TABLE IF NOT EXISTS limerick (name TEXT PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS known_bots (name TEXT PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS id_cache (name TEXT PRIMARY KEY, id TEXT, checked REAL);
+CREATE TABLE IF NOT EXISTS counters (key TEXT PRIMARY KEY, value);
+CREATE TABLE IF NOT EXISTS limericks (name TEXT PRIMARY KEY, text TEXT);
+CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY, channel TEXT, channel_id TEXT, action TEXT, status TEXT, created REAL);
+CREATE TABLE IF NOT EXISTS job_items (job_id INTEGER, name TEXT, user_id TEXT, done INTEGER DEFAULT 0, PRIMARY KEY (job_id, name));
+CREATE TABLE IF NOT EXISTS ban_ledger (channel_id TEXT, name TEXT, user_id TEXT, banned REAL, moderator_id TEXT, PRIMARY KEY (channel_id, user_id));
+CREATE TABLE IF NOT EXISTS accounts (id TEXT PRIMARY KEY, name TEXT);
+'''
+
+
+class Store:
+    def __init__(self, data_dir='data', db_file='binarybouncer.db'):
+        self.data_dir = data_dir
+        self.conn = sqlite3.connect(os.path.join(data_dir, db_file), timeout=30, isolation_level=None, check_same_thread=False)
+        self.depth = 0
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(SCHEMA)
+        self.migrate()
+        if self.get_counter('imported') is None:
+            self.import_files()
+
+    def migrate(self):
+        # Columns added to tables that older databases already have.
+        columns = {row[1] for row in self.conn.execute('PRAGMA table_info(ban_ledger)')}
+        if 'moderator_id' not in columns:
+            self.conn.execute('ALTER TABLE ban_ledger ADD COLUMN moderator_id TEXT')
+
+    @contextlib.contextmanager
+    def transaction(self):
+        # Nested calls share the outermost transaction, so a batch of changes
+        # applied together commits (or rolls back) as one.
+        if self.depth == 0:
+            self.conn.execute('BEGIN')
+        self.depth += 1
+        try:
+            yield
+        except BaseException:
+            self.depth -= 1
+            if self.depth == 0:
+                self.conn.execute('ROLLBACK')
+            raise
+        self.depth -= 1
+        if self.depth == 0:
+            self.conn.execute('COMMIT')
+
+    def apply(self, changes):
+        with self.transaction():
+            for method, args in changes:
+                getattr(self, method)(*args)
+
+    def read_file(self, filename, parse):
+        file_path = os.path.join(self.data_dir, filename)
+        try:
+            with open(file_path, 'r') as file:
+                return parse(file)
+        except FileNotFoundError:
+            return None
+        except (ValueError, json.JSONDecodeError) as e:
+            print(f'Error: Could not import {file_path}: {e}')
+            return None
+
+    def import_files(self):
+        lines = lambda file: [line.strip() for line in file if line.strip()]
+        text = lambda file: file.read().strip()
+        alive = self.read_file('alivebots.json', json.load) or {}
+        dead = self.read_file('deadbots.json', json.load) or {}
+        channels = self.read_file('channels.json', json.load) or {}
+        id_cache = self.read_file('idcache.json', json.load) or {}
+        limerick = self.read_file('limerick.txt', lines) or []
+        banlist = self.read_file('banlist.txt', lines) or []
+        with self.transaction():
+            self.conn.executemany('INSERT OR REPLACE INTO alive_bots VALUES (?, ?)', alive.items())
+            self.conn.executemany('INSERT OR REPLACE INTO dead_bots VALUES (?, ?)', dead.items())
+            self.conn.executemany('INSERT OR REPLACE INTO channels VALUES (?, ?)', channels.items())
+            self.conn.executemany('INSERT OR REPLACE INTO id_cache VALUES (?, ?, ?)', ((name, entry[0], entry[1]) for name, entry in id_cache.items()))
+            self.conn.executemany('INSERT OR IGNORE INTO limerick VALUES (?)', ((name,) for name in limerick))
+            self.conn.executemany('INSERT OR IGNORE INTO known_bots VALUES (?)', ((name,) for name in banlist))
+            counters = {key: int(self.read_file(f'{key}.txt', text) or 0) for key in ('totalBots', 'totalJoined')}
+            counters.update({key: self.read_file(f'{key}.txt', text) or '' for key in ('lastBan', 'lastRoutine')})
+            counters['imported'] = 1
+            self.conn.executemany('INSERT OR REPLACE INTO counters VALUES (?, ?)', counters.items())
+        print(f'Imported {len(alive)} alive bots, {len(dead)} dead bots and {len(channels)} channels into the database')
+
+    def add_bots(self, bots):
+        with self.transaction():
+            self.conn.executemany('INSERT OR REPLACE INTO alive_bots VALUES (?, ?)', bots.items())
+            self.conn.executemany('DELETE FROM dead_bots WHERE name = ?', ((name,) for name in bots))
+
+    def del_bots(self, bots):
+        with self.transaction():
+            self.conn.executemany('INSERT OR REPLACE INTO dead_bots VALUES (?, ?)', bots.items())
+            removed = [name for name in bots if self.conn.execute('DELETE FROM alive_bots WHERE name = ?', (name,)).rowcount]
+        return removed
+
+    def alive_bots(self):
+        return self.conn.execute('SELECT name, id FROM alive_bots')
+
+    def dead_bots(self):
+        return dict(self.conn.execute('SELECT name, id FROM dead_bots'))
+
+    def add_channel(self, channel, channel_id):
+        with self.transaction():
+            return self.conn.execute('INSERT OR IGNORE INTO channels VALUES (?, ?)', (channel, channel_id)).rowcount == 1
+
+    def remove_channel(self, channel_id):
+        with self.transaction():
+            row = self.conn.execute('SELECT name FROM channels WHERE id = ?', (str(channel_id),)).fetchone()
+            if row is None:
+                return None
+            self.conn.execute('DELETE FROM channels WHERE name = ?', row)
+        return row[0]
+
+    def has_channel(self, channel):
+        return self.conn.execute('SELECT 1 FROM channels WHERE name = ?', (channel,)).fetchone() is not None
+
+    def channels(self):
+        return dict(self.conn.execute('SELECT name, id FROM channels'))
+
+    def add_limerick(self, name):
+        with self.transaction():
+            return self.conn.execute('INSERT OR IGNORE INTO limerick VALUES (?)', (name,)).rowcount == 1
+
+    def del_limerick(self, name):
+        with self.transaction():
+            return self.conn.execute('DELETE FROM limerick WHERE name = ?', (name,)).rowcount == 1
+
+    def limerick(self):
+        return [name for name, in self.conn.execute('SELECT name FROM limerick')]
+
+    def get_limericks(self, names):
+        stories = {}
+        for name in names:
+            row = self.conn.execute('SELECT text FROM limericks WHERE name = ?', (name,)).fetchone()
+            if row is not None:
+                stories[name] = row[0]
+        return stories
+
+    def save_limericks(self, stories):
+        with self.transaction():
+            self.conn.executemany('INSERT OR REPLACE INTO limericks VALUES (?, ?)', stories.items())
+
+    def known_names(self):
+        return [name for name, in self.conn.execute('SELECT name FROM known_bots')]
+
+    def add_known(self, names):
+        with self.transaction():
+            self.conn.executemany('INSERT OR IGNORE INTO known_bots VALUES (?)', ((name,) for name in names))
+
+    def cached_ids(self, names):
+        cached = {}
+        for name in names:
+            row = self.conn.execute('SELECT id, checked FROM id_cache WHERE name = ?', (name,)).fetchone()
+            if row is not None:
+                cached[name] = row
+        return cached
+
+    def cache_ids(self, entries, checked):
+        with self.transaction():
+            self.conn.executemany('INSERT OR REPLACE INTO id_cache VALUES (?, ?, ?)', ((name, user_id, checked) for name, user_id in entries.items()))
+
+    def counters(self):
+        return dict(self.conn.execute('SELECT key, value FROM counters'))
+
+    def get_counter(self, key):
+        row = self.conn.execute('SELECT value FROM counters WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_counter(self, key, value):
+        with self.transaction():
+            self.conn.execute('INSERT OR REPLACE INTO counters VALUES (?, ?)', (key, value))
+
+    def increment(self, key, amount=1):
+        with self.transaction():
+            self.conn.execute('INSERT INTO counters VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = value + excluded.value', (key, amount))
+        return self.get_counter(key)
+
+    def create_job(self, channel, channel_id, action, bots):
+        # bots is any iterable of (name, user ID) pairs; returns the job ID
+        # and how many bots were queued.
+        with self.transaction():
+            job_id = self.conn.execute("INSERT INTO jobs (channel, channel_id, action, status, created) VALUES (?, ?, ?, 'pending', strftime('%s', 'now'))",
+                                       (channel, str(channel_id), action)).lastrowid
+            count = self.conn.executemany('INSERT OR IGNORE INTO job_items (job_id, name, user_id) VALUES (?, ?, ?)', ((job_id, name, user_id) for name, user_id in bots)).rowcount
+        return job_id, count
+
+    def open_jobs(self):
+        return self.conn.execute("SELECT id, channel, channel_id, action FROM jobs WHERE status = 'pending' ORDER BY id").fetchall()
+
+    def pending_items(self, job_id):
+        return self.conn.execute('SELECT name, user_id FROM job_items WHERE job_id = ? AND done = 0', (job_id,)).fetchall()
+
+    def mark_done(self, job_id, name):
+        with self.transaction():
+            self.conn.execute('UPDATE job_items SET done = 1 WHERE job_id = ? AND name = ?', (job_id, name))
+
+    def job_progress(self, job_id):
+        return self.conn.execute('SELECT SUM(done), COUNT(*) FROM job_items WHERE job_id = ?', (job_id,)).fetchone()
+
+    def finish_job(self, job_id, status):
+        with self.transaction():
+            self.conn.execute('UPDATE jobs SET status = ? WHERE id = ?', (status, job_id))
+            self.conn.execute('DELETE FROM job_items WHERE job_id = ?', (job_id,))
+
+    def cancel_jobs(self, channel_id):
+        with self.transaction():
+            for job_id, in self.conn.execute("SELECT id FROM jobs WHERE channel_id = ? AND status = 'pending'", (str(channel_id),)).fetchall():
+                self.finish_job(job_id, 'cancelled')
+
+    def record_ban(self, channel_id, name, user_id, moderator_id, banned):
+        with self.transaction():
+            self.conn.execute('INSERT OR REPLACE INTO ban_ledger (channel_id, name, user_id, moderator_id, banned) VALUES (?, ?, ?, ?, ?)',
+                              (str(channel_id), name, str(user_id), str(moderator_id), banned))
+
+    def forget_ban(self, channel_id, user_id):
+        with self.transaction():
+            self.conn.execute('DELETE FROM ban_ledger WHERE channel_id = ? AND user_id = ?', (str(channel_id), str(user_id)))
+
+    def ledger(self, channel_id):
+        return self.conn.execute('SELECT name, user_id, moderator_id FROM ban_ledger WHERE channel_id = ? ORDER BY banned', (str(channel_id),)).fetchall()
+
+    def add_account(self, account_id, name):
+        with self.transaction():
+            self.conn.execute('INSERT OR REPLACE INTO accounts VALUES (?, ?)', (str(account_id), name))
+
+    def accounts(self):
+        return dict(self.conn.execute('SELECT id, name FROM accounts'))
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,79 @@
+import asyncio
+import logging
+from collections import deque
+from metrics import Counter, Gauge, Histogram
+
+log = logging.getLogger(__name__)
+
+BATCH_SIZE = 10
+MAX_BACKLOG = 30
+
+LIMERICKS = Counter('limericks_total', 'Limericks by source (cache, written, summarized).')
+LIMERICK_SECONDS = Histogram('limerick_write_seconds', 'Time to write a batch of limericks.')
+LIMERICK_BACKLOG = Gauge('limerick_backlog', 'Bots waiting for a limerick.')
+
+
+class Storyteller:
+    # Limericks are written and broadcast by a worker task with its own queue,
+    # so a slow or failing OpenAI call never holds up bans.
+    def __init__(self, state, write, send, subscribers, batch_size=BATCH_SIZE, max_backlog=MAX_BACKLOG):
+        self.state = state
+        self.write = write
+        self.send = send
+        self.subscribers = subscribers
+        self.batch_size = batch_size
+        self.max_backlog = max_backlog
+        self.queue = deque()
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    def submit(self, names):
+        self.queue.extend(names)
+        LIMERICK_BACKLOG.set(len(self.queue))
+        self.wakeup.set()
+
+    async def run(self):
+        while True:
+            if not self.queue:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            batch = [self.queue.popleft() for _ in range(min(self.batch_size, len(self.queue)))]
+            skipped = []
+            if len(self.queue) > self.max_backlog:
+                skipped = list(self.queue)
+                self.queue.clear()
+            LIMERICK_BACKLOG.set(len(self.queue))
+            try:
+                await self.tell(batch, skipped)
+            except Exception as e:
+                print('found error', e)
+
+    async def tell(self, batch, skipped):
+        stories = await self.state.call('get_limericks', batch)
+        missing = [name for name in batch if name not in stories]
+        LIMERICKS.inc(len(stories), source='cache')
+        if missing:
+            with LIMERICK_SECONDS.time():
+                written = await self.write(missing)
+            self.state.defer('save_limericks', written)
+            stories.update(written)
+            LIMERICKS.inc(len(written), source='written')
+        messages = [stories[name] for name in batch if name in stories]
+        if skipped:
+            log.warning('Limerick backlog too long, summarizing %s bots', len(skipped))
+            LIMERICKS.inc(len(skipped), source='summarized')
+            messages.append(f'{len(skipped)} more bots were banned without a limerick: {", ".join(skipped[:20])}{"..." if len(skipped) > 20 else ""}')
+        for name in batch:
+            log.debug('sad story about %s: %s', name, stories.get(name))
+        for chan in await self.subscribers():
+            for message in messages:
+                self.send(chan, message)
+
+    def close(self):
+        if self.task is not None:
+            self.task.cancel()
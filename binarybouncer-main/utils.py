@@ -1,187 +1,193 @@
-import json
-import os
-import asyncio
 import datetime
-import aiohttp
-from aiohttp.client_exceptions import ClientError
-from json.decoder import JSONDecodeError
+import logging
+import time
+from state import State
+
+log = logging.getLogger(__name__)
+
+_state = None
+_feed_index = None
+
+
+class FeedIndex:
+    def __init__(self, known):
+        self.known = known
+        self.feed = set()
+
+    def seed(self, names):
+        self.feed = set(names)
+
+    def diff(self, names):
+        # Exact-match diff of a feed fetch against everything seen so far.
+        # Returns the names never seen before and the ones that left the feed.
+        current = set()
+        new_bots = []
+        for name in names:
+            if name not in current:
+                current.add(name)
+                if name not in self.known:
+                    new_bots.append(name)
+        dropped = self.feed - current if self.feed else set()
+        self.feed = current
+        return new_bots, dropped
+
+
+def get_state():
+    global _state
+    if _state is None:
+        _state = State()
+    return _state
+
+
+async def open_state():
+    global _state
+    if _state is None:
+        _state = await State.open()
+    return _state
+
+
+def get_feed_index():
+    global _feed_index
+    if _feed_index is None:
+        _feed_index = FeedIndex(get_state().known)
+    return _feed_index
+
+
+def get_limerick_index():
+    return get_state().limerick
 
 
 async def add_bot(botname, bot_id):
-    file_path = os.path.join('data', 'alivebots.json')
+    await add_bots({botname: bot_id})
+
+
+async def add_bots(bots):
     try:
-        with open(file_path, 'r') as file:
-            data = json.load(file)      
-            data[botname] = bot_id
-        with open(file_path, 'w') as file:
-            json.dump(data, file, indent=2, ensure_ascii=False)
-        print(f'Added {botname} to the alive bots with ID {bot_id}')
+        get_state().add_bots(bots)
+        for botname, bot_id in bots.items():
+            log.debug('Added %s to the alive bots with ID %s', botname, bot_id)
+        log.info('Added %s bots to the alive bots', len(bots))
     except Exception as e:
         print(f'Error adding bot: {e}')
 
 
-async def del_bot(botname, bot_id, alive_file='alivebots.json', dead_file='deadbots.json'):
-    dead_file_path = os.path.join('data', dead_file)
-    alive_file_path = os.path.join('data', alive_file)   
+async def del_bot(botname, bot_id):
+    await del_bots({botname: bot_id})
+
+
+async def del_bots(bots):
     try:
-        with open(dead_file_path, 'r') as file:
-            data = json.load(file)
-            data[botname] = bot_id
-        with open(dead_file_path, 'w') as file:
-            json.dump(data, file, indent=2, ensure_ascii=False)
-        print(f'Added {botname} to the dead bots with ID {bot_id}')
-        with open(alive_file_path, 'r') as file:
-            data = json.load(file)
-            if botname in data:
-                del data[botname]
-                with open(alive_file_path, 'w') as file:
-                    json.dump(data, file, indent=2, ensure_ascii=False)
-                print(f'Removed {botname} from the alive bots with ID {bot_id}')
+        removed = get_state().del_bots(bots)
+        for botname, bot_id in bots.items():
+            log.debug('Added %s to the dead bots with ID %s', botname, bot_id)
+        for botname in removed:
+            log.debug('Removed %s from the alive bots with ID %s', botname, bots[botname])
+        log.info('Added %s bots to the dead bots, %s of them were alive', len(bots), len(removed))
     except Exception as e:
         print(f'Error processing bot removal/addition: {e}')
 
-    
+
+async def alive_bots():
+    return get_state().alive
+
+
+async def get_channels():
+    return dict(get_state().channels)
+
+
 async def add_channel(channel, channel_id):
-    file_path = os.path.join('data', 'channels.json')
-    with open(file_path) as file:
-        old_data = json.load(file)
-        if channel not in old_data:
-            old_data[channel] = channel_id
-            with open(file_path, mode = 'w') as c:
-                json.dump(old_data, c, indent=2, ensure_ascii=False)
-        print(f"{channel} added to the Bot-Free zone -- ID: {channel_id}")
-        await update_total_joined(True)
-
-
-async def remove_channel(channel_id, channels_file='channels.json'):
-    file_path = os.path.join('data', channels_file)
+    get_state().add_channel(channel, channel_id)
+    print(f"{channel} added to the Bot-Free zone -- ID: {channel_id}")
+    await update_total_joined(True)
+
+
+async def remove_channel(channel_id):
     try:
-        with open(file_path, 'r') as c:
-            channels_data = json.load(c)
-            str_id = str(channel_id)
-            channel = next((name for name, id in channels_data.items() if str(id) == str_id), None)
-            if channel is None:
-                print('No channel found for given ID:', str_id)
-                return
-            formatted_date = datetime.datetime.now().strftime('%H:%M:%S %m/%d/%Y')
-            print('Removing a channel -- ', channel, 'at ', formatted_date)  
-            if channel in channels_data:
-                del channels_data[channel]
-                with open(file_path, 'w') as c:
-                    json.dump(channels_data, c, indent=2, ensure_ascii=False)
-                    print(channel, '- You have left the bot-free zone', str_id)
-            await update_total_joined(False)
-    except json.JSONDecodeError:
-        print('Error: Could not decode JSON from channels.json')
+        channel = get_state().remove_channel(channel_id)
+        if channel is None:
+            print('No channel found for given ID:', channel_id)
+            return
+        formatted_date = datetime.datetime.now().strftime('%H:%M:%S %m/%d/%Y')
+        print('Removing a channel -- ', channel, 'at ', formatted_date)
+        print(channel, '- You have left the bot-free zone', channel_id)
+        await update_total_joined(False)
     except Exception as e:
         print('An unexpected error occurred:', e)
 
 
-async def update_total_joined(increment=True, filename='totalJoined.txt'):
-    file_path = os.path.join('data', filename)
-    try:
-        with open(file_path, 'r+') as file:
-            counter = int(file.read().strip())
-            counter += 1 if increment else -1
-            file.seek(0)
-            file.write(str(counter))
-            file.truncate()
-        print(f"Total joined updated to: {counter}")
-    except FileNotFoundError:
-        print(f"{file_path} not found, creating a new file with a counter set to {'1' if increment else '0'}.")
-        with open(file_path, 'w') as file:
-            file.write('1' if increment else '0')
+async def update_total_joined(increment=True):
+    counter = get_state().increment('totalJoined', 1 if increment else -1)
+    print(f"Total joined updated to: {counter}")
 
 
 async def update_counters(name):
-    total_bots_path = os.path.join('data', 'totalBots.txt')
-    last_ban_path = os.path.join('data', 'lastBan.txt')
-    with open(total_bots_path, 'r+') as totalBots:
-        counter = int(totalBots.read().strip()) + 1
-        totalBots.seek(0)
-        totalBots.write(str(counter))
-        totalBots.truncate()
-    with open(last_ban_path, 'w') as lastBan:
-        lastBan.write(name)
+    counter = get_state().increment('totalBots')
+    get_state().set_counter('lastBan', name)
     print("totalBots incremented to:", counter)
 
 
 async def check_if_joined(channel):
-    file_path = os.path.join('data', 'channels.json')
-    with open(file_path, 'r') as file:
-        old_data = json.load(file)
-        if channel not in old_data:
-            return False
-        else:
-            return True
+    return channel in get_state().channels
 
 
-async def fetch_bots():
-    url = 'https://api.twitchinsights.net/v1/bots/all'
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                response.raise_for_status()
-                botlist = await response.json()
-                return botlist['bots']
-    except aiohttp.ClientResponseError as e:
-        print(f'HTTP Error: {e.status} for URL {e.request_info.url}')
-    except ClientError as e:
-        print(f'Client Error: {e}')
-    except JSONDecodeError:
-        print('Failed to decode JSON from response')
-    except Exception as e:
-        print(f'Unexpected error: {e}')
-    return None 
+async def get_channel_id(channel):
+    return get_state().channels.get(channel)
+
+
+async def record_ban(channel_id, botname, bot_id, moderator_id):
+    get_state().defer('record_ban', channel_id, botname, bot_id, moderator_id, time.time())
+
 
+async def forget_ban(channel_id, bot_id):
+    get_state().defer('forget_ban', channel_id, bot_id)
+
+
+async def banned_by_us(channel_id):
+    return await get_state().call('ledger', channel_id)
+
+
+async def add_account(account_id, name):
+    # Every account the service bans with (one per shard) is kept, so bans
+    # made by a shard that is gone can still be told apart from the streamer's.
+    get_state().defer('add_account', account_id, name)
+
+
+async def our_accounts():
+    return await get_state().call('accounts')
 
 
 async def process_bots(bots):
-    new_bots = []
-    file_path = os.path.join('data', 'banlist.txt')
-    with open(file_path, 'r+') as banlist:
-        banned = banlist.read()
-        for bot in bots:
-            name = bot[0]
-            if name not in banned:
-                print('new bot found', name)
-                new_bots.append(name)
-    with open(file_path, 'a') as banlist: 
-        for name in new_bots:
-            banlist.write(f'{name}\n')
-    return new_bots
+    new_bots, dropped = get_feed_index().diff(bot[0] for bot in bots)
+    for name in new_bots:
+        log.info('new bot found %s', name)
+    if dropped:
+        print(f'{len(dropped)} bots dropped off the feed')
+    return new_bots, dropped
+
+
+async def add_known(names):
+    # Names only become known once they resolved (or Twitch said they do not
+    # exist), so a failed lookup is retried instead of forgotten.
+    get_state().add_known(names)
 
 
 async def update_last_routine(formatted_date):
-    file_path = os.path.join('data', 'lastRoutine.txt')
-    with open(file_path, 'w') as lastRoutine:
-        lastRoutine.write(formatted_date)
+    get_state().set_counter('lastRoutine', formatted_date)
 
 
 async def check_if_in_limerick(name):
-    file_path = os.path.join('data', 'limerick.txt')
-    with open(file_path) as limerick:
-        lim = limerick.read()
-        if name not in lim:
-            return False
-        else:
-            return True
+    return name in get_limerick_index()
 
 
 async def add_to_limerick(name):
-    file_path = os.path.join('data', 'limerick.txt')
-    with open(file_path, 'r+') as limerick:
-        lim = limerick.read()
-        if name not in lim:
-            print('adding user', name, 'to the limericks')
-            limerick.write(f'{name}\n')
+    if get_state().add_limerick(name):
+        print('adding user', name, 'to the limericks')
+
+
+async def get_limerick():
+    return list(get_limerick_index())
 
 
 async def del_from_limerick(name):
-    file_path = os.path.join('data', 'limerick.txt')
-    with open(file_path) as limerick:
-        lines = limerick.readlines()
-        lines = [line for line in lines if name not in line]
-    with open(file_path, 'w') as limerick:
-        limerick.writelines(lines)     
+    get_state().del_limerick(name)
     print(f'Removed user {name} from the limericks')